@@ -7,15 +7,31 @@ from llmc.models import *
 from llmc.compression.quantization import *
 from llmc.utils.registry_factory import ALGO_REGISTRY, MODEL_REGISTRY
 from llmc.eval import PerplexityEval
+from llmc.compression import ActivationStore
 import gc
 import yaml
 from easydict import EasyDict
-from llmc.utils import seed_all, check_config, mkdirs
+from llmc.utils import seed_all, check_config, mkdirs, init_device, empty_cache, tracer
 import copy
 
 
-def main(config):
-    tokenizer = BaseTokenizer(config.model.path)
+def main(config, resume=False):
+    # mkdirs
+    if "save" in config:
+        if config.save.get("save_fp", False):
+            save_fp_path = os.path.join(config.save.save_path, "transformed_model")
+            mkdirs(save_fp_path, exist_ok=resume)
+        if config.save.get("save_quant", False):
+            save_quant_path = os.path.join(config.save.save_path, "real_quant_model")
+            mkdirs(save_quant_path, exist_ok=resume)
+        if config.save.get("save_fake", False):
+            save_fake_path = os.path.join(config.save.save_path, "fake_quant_model")
+            mkdirs(save_fake_path, exist_ok=resume)
+
+    act_store = None
+    tokenizer = BaseTokenizer(
+        config.model.path, config.model.get("tokenizer_mode", "slow")
+    )
     model = MODEL_REGISTRY[config.model.type](
         config.model.path, config.model.torch_dtype
     )
@@ -44,20 +60,26 @@ def main(config):
             logger.info(f"{ppl_eval.dataset} ppl : {ppl}")
 
     if not config.get("calib", False):
-        blockwise_opt = ALGO_REGISTRY[config.quant.method](model, config.quant)
+        blockwise_opt = ALGO_REGISTRY[config.quant.method](
+            model, config.quant, config=config
+        )
         blockwise_opt.run_block_loop()
     else:
         dataset = BaseDataset(tokenizer.get_tokenizer(), config.calib)
         calib_data = dataset.get_calib_dataset()
-        model.collect_first_block_input(calib_data)
+        if config.calib.get("act_store", False):
+            act_store = ActivationStore(
+                config.calib.act_store.path, config.calib.act_store.get("dtype", None)
+            )
+        model.collect_first_block_input(calib_data, act_store)
         del calib_data
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
 
         blockwise_opt = ALGO_REGISTRY[config.quant.method](
             model, config.quant, model.get_first_block_input(), config
         )
-        blockwise_opt.run_block_loop()
+        blockwise_opt.run_block_loop(resume=resume)
 
         if "eval" in config and "transformed" in config.eval.eval_pos:
             blockwise_opt.deploy("origin_float")
@@ -81,14 +103,28 @@ def main(config):
         blockwise_opt.deploy("fake_quant")
         blockwise_opt.save_model(save_fake_path)
 
+    if "eval" in config and "real_quant" in config.eval.eval_pos:
+        blockwise_opt.deploy("real_quant")
+        for ppl_eval in eval_list:
+            ppl = ppl_eval.eval(model)
+            logger.info(f"{ppl_eval.dataset} ppl : {ppl}")
+
     if "save" in config and config.save.get("save_quant", False):
         blockwise_opt.deploy("real_quant")
         blockwise_opt.save_model(save_quant_path)
 
+    if act_store is not None:
+        act_store.close()
+
+    if tracer.enabled:
+        tracer.export(config.base.trace_path)
+        logger.info(f"trace saved to {config.base.trace_path}\n{tracer.summary()}")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--resume", action="store_true")
     args = parser.parse_args()
 
     with open(args.config, "r") as file:
@@ -101,17 +137,8 @@ if __name__ == "__main__":
     logger.info(f"config: {config}")
 
     seed_all(config.base.seed)
+    init_device(config.base)
+    if config.base.get("trace_path", None):
+        tracer.enable()
 
-    # mkdirs
-    if "save" in config:
-        if config.save.get("save_fp", False):
-            save_fp_path = os.path.join(config.save.save_path, "transformed_model")
-            mkdirs(save_fp_path)
-        if config.save.get("save_quant", False):
-            save_quant_path = os.path.join(config.save.save_path, "real_quant_model")
-            mkdirs(save_quant_path)
-        if config.save.get("save_fake", False):
-            save_fake_path = os.path.join(config.save.save_path, "fake_quant_model")
-            mkdirs(save_fake_path)
-
-    main(config)
+    main(config, args.resume)
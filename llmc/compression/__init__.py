@@ -1 +1,2 @@
 from .blockwise_optimization import BlockwiseOpt
+from .activation_store import ActivationStore
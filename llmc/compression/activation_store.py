@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import weakref
+import torch
+from collections.abc import MutableSequence
+from loguru import logger
+
+
+class ActivationStore:
+    def __init__(self, path, dtype=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="llmc_act_", dir=path)
+        self.dtype = eval(dtype) if isinstance(dtype, str) else dtype
+        self.n_files = 0
+        logger.info(f"activation store : {self.path}, dtype : {self.dtype}")
+
+    def save(self, tensor):
+        tensor = tensor.detach()
+        if self.dtype is not None and tensor.is_floating_point():
+            dtype = self.dtype
+        else:
+            dtype = tensor.dtype
+        file_name = os.path.join(self.path, f"{self.n_files}.bin")
+        self.n_files += 1
+        mapped = torch.from_file(
+            file_name, shared=True, size=tensor.numel(), dtype=dtype
+        ).view(tensor.shape)
+        mapped.copy_(tensor)
+        return mapped, file_name
+
+    def tensor_list(self, tensors=()):
+        return SpilledTensorList(self, tensors)
+
+    def feat_dict(self):
+        return SpilledFeatDict(self)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SpilledTensorList(MutableSequence):
+    """
+    A list of tensors backed by memory-mapped files of an ActivationStore.
+    Items are handed back as views on the mapped file (zero-copy when the
+    store keeps the original dtype). Tensors assigned from another device
+    are kept there as a cache, cpu tensors are written through to the file.
+    """
+
+    def __init__(self, store, tensors=()):
+        self.store = store
+        self.mapped = []
+        self.dtypes = []
+        self.file_names = []
+        self.cached = {}
+        self.loaded = {}
+        for tensor in tensors:
+            self.append(tensor)
+
+    def __len__(self):
+        return len(self.mapped)
+
+    def index(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("SpilledTensorList index out of range")
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self.index(i)
+        if i in self.cached:
+            return self.cached[i]
+        tensor = self.mapped[i].to(self.dtypes[i])
+        self.loaded[i] = (weakref.ref(tensor), tensor._version)
+        return tensor
+
+    def __setitem__(self, i, tensor):
+        i = self.index(i)
+        if tensor.device.type != "cpu":
+            self.cached[i] = tensor
+            return
+        self.cached.pop(i, None)
+        ref, version = self.loaded.pop(i, (None, None))
+        if ref is not None and ref() is tensor and tensor._version == version:
+            return
+        if tensor.data_ptr() == self.mapped[i].data_ptr():
+            return
+        if tensor.shape == self.mapped[i].shape:
+            self.mapped[i].copy_(tensor)
+        else:
+            os.remove(self.file_names[i])
+            self.mapped[i], self.file_names[i] = self.store.save(tensor)
+        self.dtypes[i] = tensor.dtype
+
+    def __delitem__(self, i):
+        i = self.index(i)
+        os.remove(self.file_names[i])
+        del self.mapped[i], self.dtypes[i], self.file_names[i]
+        self.cached = {j - (j > i): t for j, t in self.cached.items() if j != i}
+        self.loaded.clear()
+
+    def insert(self, i, tensor):
+        assert i == len(self), "SpilledTensorList only supports append."
+        mapped, file_name = self.store.save(tensor)
+        self.mapped.append(mapped)
+        self.dtypes.append(tensor.dtype)
+        self.file_names.append(file_name)
+
+    def clear(self):
+        for file_name in self.file_names:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.mapped, self.dtypes, self.file_names = [], [], []
+        self.cached.clear()
+        self.loaded.clear()
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass
+
+
+class SpilledFeatDict(dict):
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def __missing__(self, key):
+        self[key] = self.store.tensor_list()
+        return self[key]
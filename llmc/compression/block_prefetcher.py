@@ -0,0 +1,84 @@
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from loguru import logger
+from llmc.utils.device import get_device
+from llmc.utils.tracer import tracer, module_bytes
+
+
+class BlockPrefetcher:
+    """
+    Moves blocks between host and device on a background worker with its own
+    cuda stream: the next ``lookahead`` blocks are staged and finished blocks
+    are written back while the current block is optimized. ``mem_cap_gb``
+    bounds the device memory of the current, staged and in-flight blocks.
+    """
+
+    def __init__(self, blocks, lookahead=1, mem_cap_gb=None):
+        self.blocks = blocks
+        self.lookahead = lookahead
+        self.mem_cap = None if mem_cap_gb is None else mem_cap_gb * 1024**3
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.cuda = get_device().type == "cuda"
+        self.stream = torch.cuda.Stream(get_device()) if self.cuda else None
+        self.staged = {}
+        self.offloading = {}
+        self.current_bytes = 0
+        logger.info(
+            f"block prefetch : lookahead {lookahead}, mem_cap_gb {mem_cap_gb}"
+        )
+
+    def move(self, block, device, event=None):
+        with torch.cuda.stream(self.stream) if self.cuda else nullcontext():
+            if event is not None:
+                self.stream.wait_event(event)
+            block.to(device)
+        tracer.add_module_bytes(block)
+        if self.cuda:
+            self.stream.synchronize()
+
+    def resident_bytes(self):
+        for idx in [idx for idx, (f, _) in self.offloading.items() if f.done()]:
+            self.offloading.pop(idx)[0].result()
+        pending = list(self.staged.values()) + list(self.offloading.values())
+        return self.current_bytes + sum(nbytes for _, nbytes in pending)
+
+    def fetch(self, idx):
+        block = self.blocks[idx]
+        if idx in self.staged:
+            self.staged.pop(idx)[0].result()
+            if self.cuda:
+                # The staged tensors were allocated on the copy stream, keep the
+                # allocator from reusing them before compute on them finishes.
+                for t in list(block.parameters()) + list(block.buffers()):
+                    t.data.record_stream(torch.cuda.current_stream())
+        else:
+            block.to(get_device())
+            tracer.add_module_bytes(block)
+        self.current_bytes = module_bytes(block)
+
+        for j in range(idx + 1, min(idx + 1 + self.lookahead, len(self.blocks))):
+            if j in self.staged:
+                continue
+            nbytes = module_bytes(self.blocks[j])
+            if self.mem_cap is not None and self.resident_bytes() + nbytes > self.mem_cap:
+                break
+            future = self.executor.submit(self.move, self.blocks[j], get_device())
+            self.staged[j] = (future, nbytes)
+
+    def offload(self, idx):
+        event = None
+        if self.cuda:
+            event = torch.cuda.Event()
+            event.record()
+        block = self.blocks[idx]
+        future = self.executor.submit(self.move, block, "cpu", event)
+        self.offloading[idx] = (future, module_bytes(block))
+        self.current_bytes = 0
+
+    def close(self):
+        for future, _ in list(self.staged.values()) + list(self.offloading.values()):
+            future.result()
+        self.staged.clear()
+        self.offloading.clear()
+        self.executor.shutdown()
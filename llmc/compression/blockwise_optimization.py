@@ -1,14 +1,47 @@
+import os
+import shutil
+import torch
 from loguru import logger
 from abc import abstractmethod, ABCMeta
+from collections import defaultdict
+from .activation_store import SpilledTensorList
+from .block_prefetcher import BlockPrefetcher
+from llmc.utils.device import get_device
+from llmc.utils.tracer import traced, tracer
 
 
 class BlockwiseOpt(metaclass=ABCMeta):
+    # Methods recorded as tracer spans, also where subclasses override them.
+    traced_methods = (
+        "block_opt",
+        "block_forward",
+        "block_transform",
+        "subset_transform",
+        "layer_transform",
+        "deploy",
+        "save_model",
+    )
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in BlockwiseOpt.traced_methods:
+            if name in cls.__dict__:
+                setattr(cls, name, traced(name)(cls.__dict__[name]))
+
     def __init__(self, model, quant_config, input, config):
         self.model = model
         self.blocks = model.get_blocks()
         self.quant_config = quant_config
         self.input = input
         self.config = config
+        self.act_store = None
+        self.ckpt_path = None
+        if config is not None and "save" in config:
+            self.ckpt_path = config.save.get("ckpt_path", None)
+        self.prefetch_config = None
+        if config is not None and "base" in config:
+            self.prefetch_config = config.base.get("block_prefetch", None)
+        self.prefetcher = None
         if self.input:
             for i in range(len(input["kwargs"])):
                 if "use_cache" in input["kwargs"][i]:
@@ -16,17 +49,142 @@ class BlockwiseOpt(metaclass=ABCMeta):
             self.n_samples = 0
             for i in range(len(input["data"])):
                 self.n_samples += input["data"][i].shape[0]
+            if isinstance(input["data"], SpilledTensorList):
+                self.act_store = input["data"].store
 
-    def run_block_loop(self):
-        for i in range(len(self.blocks)):
-            logger.info(f"\nindex: {i+1}/{len(self.blocks)} \nblock: {self.blocks[i]}")
-            self.block_opt(self.blocks[i], i)
+    def run_block_loop(self, resume=False):
+        start = self.load_checkpoint() if resume else 0
+        if self.prefetch_config:
+            self.prefetcher = BlockPrefetcher(self.blocks, **self.prefetch_config)
+        try:
+            for i in range(start, len(self.blocks)):
+                logger.info(
+                    f"\nindex: {i+1}/{len(self.blocks)} \nblock: {self.blocks[i]}"
+                )
+                if self.prefetcher is not None:
+                    self.prefetcher.fetch(i)
+                self.block_opt(self.blocks[i], i)
+                self.save_checkpoint(i)
+                if self.prefetcher is not None:
+                    self.prefetcher.offload(i)
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+                self.prefetcher = None
+
+    def onload_block(self, block):
+        # With prefetching, the block is already staged on the device.
+        if self.prefetcher is None:
+            block.to(get_device())
+            tracer.add_module_bytes(block)
+        return block
+
+    def offload_block(self, block):
+        # With prefetching, run_block_loop writes the block back in the background.
+        if self.prefetcher is None:
+            tracer.add_module_bytes(block)
+            block.cpu()
+
+    def ckpt_tensor_lists(self):
+        return {"input": self.input["data"]}
+
+    def restore_tensor_list(self, name, tensors):
+        if name == "input":
+            self.input["data"] = tensors
+        else:
+            setattr(self, name, tensors)
+
+    @torch.no_grad()
+    def save_checkpoint(self, idx):
+        if self.ckpt_path is None or not self.input:
+            return
+        os.makedirs(self.ckpt_path, exist_ok=True)
+        torch.save(
+            self.blocks[idx].state_dict(),
+            os.path.join(self.ckpt_path, f"block_{idx}.pth"),
+        )
+        # Activations of each block go to a new dir, and state.pth is replaced
+        # atomically, so a crash while saving keeps the previous checkpoint.
+        act_path = os.path.join(self.ckpt_path, f"act_{idx}")
+        os.makedirs(act_path, exist_ok=True)
+        tensor_lists = {}
+        for name, tensors in self.ckpt_tensor_lists().items():
+            tensor_lists[name] = len(tensors)
+            for i in range(len(tensors)):
+                torch.save(tensors[i], os.path.join(act_path, f"{name}_{i}.pth"))
+        state = {
+            "block_idx": idx,
+            "kwargs": self.input["kwargs"],
+            "tensor_lists": tensor_lists,
+        }
+        torch.save(state, os.path.join(self.ckpt_path, "state.pth.tmp"))
+        os.replace(
+            os.path.join(self.ckpt_path, "state.pth.tmp"),
+            os.path.join(self.ckpt_path, "state.pth"),
+        )
+        shutil.rmtree(os.path.join(self.ckpt_path, f"act_{idx - 1}"), True)
+        logger.info(f"Save checkpoint of the {idx+1}-th block to {self.ckpt_path}")
+
+    @torch.no_grad()
+    def load_checkpoint(self):
+        state_path = os.path.join(str(self.ckpt_path), "state.pth")
+        if not os.path.exists(state_path):
+            logger.info(f"No checkpoint found in {self.ckpt_path}, start from scratch.")
+            return 0
+        state = torch.load(state_path, map_location=get_device())
+        for idx in range(state["block_idx"] + 1):
+            block_state = torch.load(
+                os.path.join(self.ckpt_path, f"block_{idx}.pth"), map_location="cpu"
+            )
+            self.load_block_state(self.blocks[idx], idx, block_state)
+
+        self.input["kwargs"] = state["kwargs"]
+        act_path = os.path.join(self.ckpt_path, f"act_{state['block_idx']}")
+        for name, length in state["tensor_lists"].items():
+            tensors = self.new_tensor_list()
+            for i in range(length):
+                tensors.append(
+                    torch.load(
+                        os.path.join(act_path, f"{name}_{i}.pth"),
+                        map_location="cpu",
+                        mmap=True,
+                    )
+                )
+            self.restore_tensor_list(name, tensors)
+        logger.info(
+            f"Resume from the {state['block_idx']+1}-th block checkpoint "
+            f"in {self.ckpt_path}"
+        )
+        return state["block_idx"] + 1
+
+    def load_block_state(self, block, idx, state_dict):
+        # Blocks are restored into the original modules. Qparams and other
+        # tensors registered by the algorithm come back as buffers.
+        for key, tensor in state_dict.items():
+            module_name, _, attr = key.rpartition(".")
+            module = block.get_submodule(module_name)
+            if module._parameters.get(attr, None) is not None:
+                module._parameters[attr].data = tensor
+            else:
+                if hasattr(module, attr) and attr not in module._buffers:
+                    delattr(module, attr)
+                module.register_buffer(attr, tensor)
 
     def run_block_cvt(self):
         for i in range(len(self.blocks)):
             logger.info(f"Convert block index: {i+1}/{len(self.blocks)}")
             self.block_cvt(self.blocks[i], i)
 
+    def new_tensor_list(self):
+        if self.act_store is None:
+            return []
+        return self.act_store.tensor_list()
+
+    def new_feat_dict(self):
+        if self.act_store is None:
+            return defaultdict(list)
+        return self.act_store.feat_dict()
+
     @abstractmethod
     def block_opt(self, block, idx):
         pass
@@ -14,3 +14,5 @@ from .hqq import HQQ
 from .rtn import RTN
 from .quant import Quantizer
 from .module_utils import FakeQuantLinear
+from .pack import pack_tensor, unpack_tensor
+from .qparam_store import QParamStore
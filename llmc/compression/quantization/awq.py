@@ -7,6 +7,7 @@ from transformers.models.mistral.modeling_mistral import MistralRMSNorm
 from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
 from .module_utils import FakeQuantLinear
+from llmc.utils.device import get_device, empty_cache
 
 
 @ALGO_REGISTRY
@@ -21,6 +22,14 @@ class Awq(BaseBlockwiseQuantization):
             self.weight_clip = self.quant_config["special"]["weight_clip"]
         else:
             self.weight_clip = True
+        if "special" in self.quant_config and "grid_batch" in self.quant_config["special"]:
+            self.grid_batch = self.quant_config["special"]["grid_batch"]
+        else:
+            self.grid_batch = 1
+        if "special" in self.quant_config and "clip_mem_gb" in self.quant_config["special"]:
+            self.clip_mem_gb = self.quant_config["special"]["clip_mem_gb"]
+        else:
+            self.clip_mem_gb = 2
 
     @torch.no_grad()
     def get_weight_scale(self, layers):
@@ -33,7 +42,7 @@ class Awq(BaseBlockwiseQuantization):
         scale = scale.mean(0)
         del weights
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
         return scale
 
     @torch.no_grad()
@@ -48,79 +57,106 @@ class Awq(BaseBlockwiseQuantization):
                 org_out = org_out[0]
         return org_out
 
+    def get_scales(self, x_max, w_max, ratio):
+        if self.version == "v1":
+            scales = (x_max.pow(ratio) / w_max.pow(1 - ratio)).clamp(min=1e-4).view(-1)
+        elif self.version == "v2":
+            scales = x_max.pow(ratio).clamp(min=1e-4).view(-1)
+        return scales / (scales.max() * scales.min()).sqrt()
+
     @torch.no_grad()
     def search_scale_subset(self, layers, input, inspect_module, subset_kwargs):
         w_max = self.get_weight_scale(layers)
         # grid search for ratio
-        best_error = float("inf")
-        best_scales = None
         n_grid = 20
-        org_sd = {k: v.cpu() for k, v in inspect_module.state_dict().items()}
+        # Candidates only rewrite fc.weight, keep the originals to restore them.
+        org_weights = [fc.weight.data for fc in layers]
+        batched = (
+            self.grid_batch > 1
+            and self.w_only
+            and len(layers) == 1
+            and inspect_module is layers[0]
+        )
+
+        loss_mean = [0] * n_grid
+        scales_mean = [0] * n_grid
+        for i in range(len(input)):
+            x = input[i].to(next(inspect_module.parameters()).device)
+            if isinstance(subset_kwargs, list):
+                kwargs = subset_kwargs[i]
+            else:
+                kwargs = subset_kwargs
+            org_out = self.get_original_out(x, inspect_module, kwargs)
+            x_max = self.get_act_scale(x)
+            all_scales = [self.get_scales(x_max, w_max, n / n_grid) for n in range(n_grid)]
+
+            if batched:
+                losses = self.batched_grid_loss(
+                    layers[0], org_weights[0], x, org_out, all_scales
+                )
+            else:
+                losses = []
+                for scales in all_scales:
+                    for fc, org_w in zip(layers, org_weights):
+                        fc.weight.data = self.wquantizer.fake_quant_weight_dynamic(
+                            org_w * scales.view(1, -1)
+                        )
 
-        org_out_dict = {}
+                    x_tmp = x / scales.view(1, -1)
+                    if not self.w_only:
+                        x_tmp = self.aquantizer.fake_quant_act_dynamic(x_tmp)
+
+                    out = inspect_module(x_tmp, **kwargs)
+
+                    if isinstance(out, tuple):
+                        out = out[0]
+
+                    losses.append((org_out - out).float().pow(2).mean())
+                    for fc, org_w in zip(layers, org_weights):
+                        fc.weight.data = org_w
+                losses = torch.stack(losses).tolist()
+            for n in range(n_grid):
+                loss_mean[n] += x.shape[0] * 1.0 / self.n_samples * losses[n]
+                scales_mean[n] += x.shape[0] * 1.0 / self.n_samples * all_scales[n]
+            del org_out
+
+        best_error = float("inf")
+        best_scales = None
         for n in range(n_grid):
-            loss_mean = 0
-            scales_mean = 0
-            for i in range(len(input)):
-                input[i] = input[i].to(next(inspect_module.parameters()).device)
-                x = input[i]
-                if isinstance(subset_kwargs, list):
-                    kwargs = subset_kwargs[i]
-                else:
-                    kwargs = subset_kwargs
-                if i in org_out_dict:
-                    org_out = org_out_dict[i]
-                else:
-                    org_out = self.get_original_out(x, inspect_module, kwargs)
-                    org_out_dict[i] = org_out
-                x_max = self.get_act_scale(x)
-
-                ratio = n * 1 / n_grid
-                if self.version == "v1":
-                    scales = (
-                        (x_max.pow(ratio) / w_max.pow(1 - ratio))
-                        .clamp(min=1e-4)
-                        .view(-1)
-                    )
-                elif self.version == "v2":
-                    scales = x_max.pow(ratio).clamp(min=1e-4).view(-1)
-                scales = scales / (scales.max() * scales.min()).sqrt()
-                for fc in layers:
-                    fc.weight.mul_(scales.view(1, -1))
-
-                    fc.weight.data = self.wquantizer.fake_quant_weight_dynamic(
-                        fc.weight.data
-                    )
-
-                x_tmp = x / scales.view(1, -1)
-                if not self.w_only:
-                    x_tmp = self.aquantizer.fake_quant_act_dynamic(x_tmp)
-
-                out = inspect_module(x_tmp, **kwargs)
-
-                if isinstance(out, tuple):
-                    out = out[0]
-
-                loss = (org_out - out).float().pow(2).mean().item()
-                loss_mean += x.shape[0] * 1.0 / self.n_samples * loss
-                scales_mean += x.shape[0] * 1.0 / self.n_samples * scales
-                inspect_module.load_state_dict(org_sd)
-            is_best = loss_mean < best_error
-            if is_best:
-                best_error = loss_mean
-                best_scales = scales_mean
+            if loss_mean[n] < best_error:
+                best_error = loss_mean[n]
+                best_scales = scales_mean[n]
         best_scales = best_scales.view(-1)
-        del org_out_dict
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
         return best_scales
 
+    @torch.no_grad()
+    def batched_grid_loss(self, fc, org_w, x, org_out, all_scales):
+        # Evaluate grid_batch candidates of a linear inspect module per bmm.
+        x = x.view(-1, x.shape[-1])
+        org_out = org_out.view(-1, org_out.shape[-1])
+        losses = []
+        for b in range(0, len(all_scales), self.grid_batch):
+            scales = torch.stack(all_scales[b : b + self.grid_batch]).unsqueeze(1)
+            q_w = torch.stack(
+                [self.wquantizer.fake_quant_weight_dynamic(org_w * s) for s in scales]
+            )
+            x_tmp = x.unsqueeze(0) / scales
+            if fc.bias is None:
+                out = torch.bmm(x_tmp, q_w.transpose(1, 2))
+            else:
+                out = torch.baddbmm(fc.bias.view(1, 1, -1), x_tmp, q_w.transpose(1, 2))
+            losses.extend((org_out - out).float().pow(2).mean(dim=(1, 2)).tolist())
+            del q_w, x_tmp, out
+        return losses
+
     @torch.no_grad()
     def update_input_feat(self, scale, input_feat, layers_dict):
         for layer_name in layers_dict:
             for i in range(len(input_feat[layer_name])):
                 inp = input_feat[layer_name][i]
-                inp.div_(scale.view(1, -1).to(inp.device))
+                input_feat[layer_name][i] = inp.div(scale.view(1, -1).to(inp.device))
 
     @torch.no_grad()
     def auto_clip_layer(
@@ -138,58 +174,82 @@ class Awq(BaseBlockwiseQuantization):
         else:
             group_size = w.shape[1]
 
-        w = w.reshape(w.shape[0], 1, -1, group_size)
-        oc_batch_size = 256 if w.shape[0] % 256 == 0 else 64  # prevent OOM
-        assert w.shape[0] % oc_batch_size == 0
+        w = w.reshape(w.shape[0], -1, group_size)  # co, n_group, group_size
+        n_group = w.shape[1]
 
-        w_all = w
-        best_max_val_all = []
+        xs = []
+        for i in range(len(input)):
+            x = input[i].to(w.device)
+            x = x.view(-1, x.shape[-1])
+            x = x[0 :: max(1, x.shape[0] // n_sample_token)]
+            # n_group, group_size, n_token
+            xs.append(x.reshape(-1, n_group, group_size).permute(1, 2, 0).float())
+        n_token = max(x.shape[-1] for x in xs)
 
-        for i_b in range(w.shape[0] // oc_batch_size):
-            w = w_all[i_b * oc_batch_size : (i_b + 1) * oc_batch_size]
-            org_max_val = w.abs().amax(dim=-1, keepdim=True)  # co, 1, n_group, 1
+        # The error of a clipped weight only depends on dw = q_w - w. When
+        # groups are narrower than the sampled tokens, mean((dw @ x) ** 2)
+        # is evaluated as dw^T G dw with a per-group gram G of the inputs.
+        use_gram = group_size < n_token * len(xs)
+        if use_gram:
+            gram = sum(x @ x.transpose(1, 2) / x.shape[-1] for x in xs) / len(xs)
+            xs = []
+            resident = [gram]
+            row_bytes = w.shape[1] * group_size * (4 * 3 + 2 * w.element_size())
+        else:
+            resident = xs
+            row_bytes = w.shape[1] * (
+                group_size * (4 * 2 + 2 * w.element_size()) + 4 * n_token
+            )
+
+        n_shrink = int(max_shrink * n_grid)
+        # The gram or the sampled inputs stay allocated during the search.
+        resident_bytes = sum(t.numel() * t.element_size() for t in resident)
+        budget = max(int(self.clip_mem_gb * 1024**3) - resident_bytes, 0)
+        n_cand = min(n_shrink, max(1, budget // row_bytes))
+        oc_batch_size = max(1, budget // (n_cand * row_bytes))
+
+        best_max_val_all = []
+        for oc in range(0, w.shape[0], oc_batch_size):
+            w_b = w[oc : oc + oc_batch_size]
+            org_max_val = w_b.abs().amax(dim=-1, keepdim=True)  # co, n_group, 1
 
             best_max_val = org_max_val.clone()
-            min_errs = torch.ones_like(org_max_val) * 1e9
-            org_out_dict = {}
-            for i_s in range(int(max_shrink * n_grid)):
-                err_mean = 0
-                for i in range(len(input)):
-                    input[i] = input[i].to(w.device)
-                    x = input[i]
-                    x = x.view(-1, x.shape[-1])
-                    x = x.reshape(1, x.shape[0], -1, group_size)
-                    x = x[:, 0 :: x.shape[1] // n_sample_token]
-                    if i in org_out_dict:
-                        org_out = org_out_dict[i]
-                    else:
-                        org_out = (x * w).sum(dim=-1)  # co, n_token, n_group
-                        org_out_dict[i] = org_out
-                    max_val = org_max_val * (1 - i_s / n_grid)
-                    min_val = -max_val
-                    cur_w = torch.clamp(w, min_val, max_val)
-
-                    q_w = self.wquantizer.fake_quant_weight_dynamic(cur_w)
-
-                    cur_out = (x * q_w).sum(dim=-1)
-
-                    # co, 1, n_group, 1
-                    err = (cur_out - org_out).pow(2).mean(dim=1).view(min_errs.shape)
-                    err_mean += err
-                    del cur_w
-                    del cur_out
-                err_mean /= len(input)
-                cur_best_idx = err_mean < min_errs
-                min_errs[cur_best_idx] = err_mean[cur_best_idx]
-                best_max_val[cur_best_idx] = max_val[cur_best_idx]
+            min_errs = torch.full(org_max_val.shape, float("inf"), device=w.device)
+            for i_s in range(0, n_shrink, n_cand):
+                max_val = torch.stack(
+                    [
+                        org_max_val * (1 - j / n_grid)
+                        for j in range(i_s, min(i_s + n_cand, n_shrink))
+                    ]
+                )
+                cur_w = torch.clamp(w_b.unsqueeze(0), -max_val, max_val)
+                q_w = torch.stack(
+                    [self.wquantizer.fake_quant_weight_dynamic(c) for c in cur_w]
+                )
+                del cur_w
+
+                # n_cand, n_group, co, group_size
+                dw = (q_w.float() - w_b.float()).transpose(1, 2)
+                del q_w
+                if use_gram:
+                    err = (dw @ gram).mul_(dw).sum(dim=-1)
+                else:
+                    err = sum((dw @ x).pow_(2).mean(dim=-1) for x in xs) / len(xs)
+                err = err.transpose(1, 2).unsqueeze(-1)  # n_cand, co, n_group, 1
+                del dw
+
+                cur_min_errs, cur_best = err.min(dim=0)
+                cur_best_idx = cur_min_errs < min_errs
+                min_errs[cur_best_idx] = cur_min_errs[cur_best_idx]
+                cur_max_val = max_val.gather(0, cur_best.unsqueeze(0)).squeeze(0)
+                best_max_val[cur_best_idx] = cur_max_val[cur_best_idx]
             best_max_val_all.append(best_max_val)
         best_max_val = torch.cat(best_max_val_all, dim=0)
 
-        del org_out
-        del org_out_dict
+        del xs
         gc.collect()
-        torch.cuda.empty_cache()
-        return best_max_val.squeeze(1)
+        empty_cache()
+        return best_max_val
 
     @torch.no_grad()
     def block_transform(self, block, input_feat, idx, block_kwargs):
@@ -209,7 +269,7 @@ class Awq(BaseBlockwiseQuantization):
             if any([_ in name for _ in ["q_", "k_", "query", "key", "Wqkv"]]):
                 continue
             logger.info(f"clip layer: {name}")
-            named_linears[name].cuda()
+            named_linears[name].to(get_device())
             max_val = self.auto_clip_layer(
                 named_linears[name].weight,
                 input_feat[name],
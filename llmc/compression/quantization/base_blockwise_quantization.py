@@ -1,9 +1,10 @@
 from loguru import logger
+import os
 import torch
 import torch.nn as nn
 import gc
 import functools
-from collections import defaultdict
+from collections import deque
 from ..blockwise_optimization import BlockwiseOpt
 from transformers.models.llama.modeling_llama import LlamaRMSNorm
 from transformers.models.mistral.modeling_mistral import MistralRMSNorm
@@ -17,9 +18,16 @@ from .module_utils import (
     LlmcMistralRMSNorm,
 )
 from .quant import Quantizer
+from .qparam_store import QParamStore
+from .layer_pool import LayerPool
+from llmc.utils.device import get_device, empty_cache
 
 
 class BaseBlockwiseQuantization(BlockwiseOpt):
+    # Whether w_qdq / w_q only read the weight and buf_* qparams of a linear,
+    # so that deploy can run them in a LayerPool.
+    parallel_layers = False
+
     def __init__(self, model, quant_config, input, config):
         super().__init__(model, quant_config, input, config)
         self.set_quant_config()
@@ -31,7 +39,7 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
         return self.wquantizer.fake_quant_weight_dynamic(module.weight.data)
 
     def w_q(self, module):
-        return self.wquantizer.fake_quant_weight_dynamic(module.weight.data)
+        return self.wquantizer.real_quant_weight_dynamic(module.weight.data)
 
     def a_qdq(self, act, module=None):
         return self.aquantizer.fake_quant_act_dynamic(act)
@@ -52,28 +60,34 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
         else:
             self.w_only = True
 
+        self.num_workers = self.quant_config.get("num_workers", 0)
+        if self.num_workers and get_device().type != "cpu":
+            logger.info("num_workers only takes effect on cpu, quantize in-process.")
+            self.num_workers = 0
+
     def block_forward(self, block, input_data=None):
-        output = []
+        output = self.new_tensor_list()
 
         if input_data is None:
             input_data = self.input["data"]
 
         for i in range(len(input_data)):
-            input_data[i] = input_data[i].to(device=next(block.parameters()).device)
+            # A local copy, writing it back would keep it cached in a spilled list.
+            x = input_data[i].to(device=next(block.parameters()).device)
             if "attention_mask" in self.input["kwargs"][i]:
                 self.input["kwargs"][i]["attention_mask"] = self.input["kwargs"][i][
                     "attention_mask"
-                ].cuda()
+                ].to(get_device())
             with torch.no_grad():
-                out = block(input_data[i], **self.input["kwargs"][i])[0]
+                out = block(x, **self.input["kwargs"][i])[0]
                 output.append(out)
         return output
 
     def block_opt(self, block, idx):
-        block = block.cuda()
+        block = self.onload_block(block)
         named_linears = self.model.get_block_linears(block)
         logger.info(f"named_linears: {named_linears}")
-        input_feat = defaultdict(list)
+        input_feat = self.new_feat_dict()
         handles = []
         self.block_init(block)
 
@@ -93,7 +107,7 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
 
         for h in handles:
             h.remove()
-        torch.cuda.empty_cache()
+        empty_cache()
 
         self.block_transform(block, input_feat, idx, self.input["kwargs"])
 
@@ -104,10 +118,10 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
             self.model.replace_module_block(FakeQuantLinear, block, idx, params_dict)
             self.input["data"] = self.block_forward(block)
 
-        block = block.cpu()
+        self.offload_block(block)
         del input_feat
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
 
     def block_transform(self, block, input_feat, idx, block_kwargs):
         logger.info(f"Start transform the {idx+1}-th block")
@@ -310,6 +324,8 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
             else:
                 params_dict["w_qdq"] = self.w_qdq
         elif quant_format == "real_quant":
+            # After a fake_quant deploy, w_q sees the fake quant weights, whose
+            # dynamic qparams can come out one step narrower than the original.
             module = RealQuantLinear
             params_dict["w_q"] = self.w_q
             params_dict["quant_config"] = self.quant_config
@@ -318,9 +334,57 @@ class BaseBlockwiseQuantization(BlockwiseOpt):
             params_dict = {}
         else:
             raise NotImplementedError
-        self.model.replace_module_all(module, params_dict)
+
+        pool = None
+        if self.parallel_layers and self.num_workers and quant_format != "origin_float":
+            pool = LayerPool(self, self.num_workers)
+            key = "w_q" if quant_format == "real_quant" else "w_qdq"
+            params_dict[key] = self.pooled_fn(pool, params_dict[key], module)
+        try:
+            self.model.replace_module_all(module, params_dict)
+        finally:
+            if pool is not None:
+                pool.close()
         logger.info(f"-- deploy_{quant_format}_model done --")
 
+    def pooled_fn(self, pool, fn, module):
+        # Results come back in the order replace_module_all walks the linears,
+        # which are only referenced by the model once submitted.
+        layers = deque(
+            layer
+            for block in self.blocks
+            for layer in self.model.get_block_linears(block).values()
+            if not isinstance(layer, module)
+        )
+        ids = deque(map(id, layers))
+
+        def take():
+            while layers:
+                yield layers.popleft()
+
+        results = pool.imap(fn.__name__, take())
+        done = {}
+
+        @functools.wraps(fn)
+        def pooled(layer):
+            while id(layer) not in done:
+                if not ids:
+                    return fn(layer)
+                done[ids.popleft()] = next(results)
+            return done.pop(id(layer))
+
+        return pooled
+
     @torch.no_grad()
     def save_model(self, path):
-        self.model.get_model().save_pretrained(path)
\ No newline at end of file
+        qparam_store = QParamStore.from_blocks(self.blocks)
+        if len(qparam_store):
+            qparam_store.save(os.path.join(path, "qparams.pth"))
+        # Clone the qparam views, torch.save would write the whole flat tensor
+        # of the store for each of them, and densify the sparse ones (SpQR's
+        # outlier mask), which save_pretrained can not shard.
+        state_dict = {
+            k: v.to_dense() if v.is_sparse else v.clone() if ".buf_" in k else v
+            for k, v in self.model.get_model().state_dict().items()
+        }
+        self.model.get_model().save_pretrained(path, state_dict=state_dict)
\ No newline at end of file
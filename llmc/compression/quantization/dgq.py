@@ -8,6 +8,7 @@ from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
 from .module_utils import FakeQuantLinear
 from .quant import Quantizer
+from llmc.utils.device import get_device, empty_cache
 
 
 @ALGO_REGISTRY
@@ -69,14 +70,14 @@ class DGQ(BaseBlockwiseQuantization):
         scale = scale.max(dim=0)[0].clamp(min=1e-5)
         del weights
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
         return scale
 
     @torch.no_grad()
     def get_act_scale(self, tensors):
         scale_max = None
         for x in tensors:
-            x = x.cuda()
+            x = x.to(get_device())
             x = x.abs().view(-1, x.shape[-1])
             comming_max = torch.max(x, dim=0)[0].float()
             if scale_max is not None:
@@ -103,7 +104,7 @@ class DGQ(BaseBlockwiseQuantization):
     def smooth_llama_mlp(self, upp, downp, act_scales):
         device, dtype = downp.weight.device, downp.weight.dtype
 
-        downp_scales = downp.weight.abs().max(dim=0)[0].cuda().float().clamp(min=1e-5)
+        downp_scales = downp.weight.abs().max(dim=0)[0].to(get_device()).float().clamp(min=1e-5)
 
         maxsv, inds = act_scales.sort()
         basl = int(len(act_scales) * 0.005 + 1.5)  # hyperparameter
@@ -9,15 +9,15 @@ from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
 import time
 import math
-import copy
 from .module_utils import FakeQuantLinear
+from llmc.utils.device import get_device, empty_cache, synchronize
 
 
 @ALGO_REGISTRY
 class GPTQ(BaseBlockwiseQuantization):
     def __init__(self, model, quant_config, input, config):
         super().__init__(model, quant_config, input, config)
-        self.dev = torch.device("cuda")
+        self.dev = get_device()
         self.model_dtype = next(self.model.model.parameters()).dtype
         self.add_quant_config()
         self.layers_cache = {}
@@ -108,7 +108,7 @@ class GPTQ(BaseBlockwiseQuantization):
                 self.block_forward(block)
                 for h in handles:
                     h.remove()
-                torch.cuda.empty_cache()
+                empty_cache()
 
                 self.subset_transform(subset["layers"])
                 params_dict = {}
@@ -163,21 +163,16 @@ class GPTQ(BaseBlockwiseQuantization):
 
         if not self.ready():
             if self.wquantizer.granularity == "per_group":
-                self.groups = []
                 self.search_group_qparams(layer)
             else:
                 self.search_layer_qparams(layer)
 
         H = self.layers_cache[name]["H"]
-        del self.layers_cache[name]["H"]
-
         dead = torch.diag(H) == 0
-        H[dead, dead] = 1
         W[:, dead] = 0
 
         if self.actorder or self.owq:
             W = W[:, self.perm]
-            H = H[self.perm][:, self.perm]
 
             self.invperm = torch.argsort(self.perm)
             layer.register_buffer("buf_perm", self.perm)
@@ -201,17 +196,11 @@ class GPTQ(BaseBlockwiseQuantization):
         Losses = torch.zeros_like(W)
         tmp = torch.zeros_like(W)
 
-        damp = self.percdamp * torch.mean(torch.diag(H))
-        diag = torch.arange(self.columns, device=self.dev)
-        H[diag, diag] += damp
-        H = torch.linalg.cholesky(H)
-        H = torch.cholesky_inverse(H)
-        H = torch.linalg.cholesky(H, upper=True)
-        Hinv = H
+        Hinv = self.get_hinv(name)
 
         self.weight_transform(W, Hinv, Losses, tmp)
 
-        torch.cuda.synchronize()
+        synchronize()
         logger.info(f"time {time.time() - tick}")
         logger.info(f"error {torch.sum(Losses).item()}")
 
@@ -227,37 +216,58 @@ class GPTQ(BaseBlockwiseQuantization):
         if self.wquantizer.granularity == "per_group" and not self.static_groups:
             self.update_model_qparams(layer)
 
+    @torch.no_grad()
+    def get_hinv(self, name):
+        cache = self.layers_cache[name]
+        if "Hinv" in cache:
+            return cache["Hinv"]
+
+        H = cache["H"].clone()
+        dead = torch.diag(H) == 0
+        H[dead, dead] = 1
+        if self.actorder or self.owq:
+            H = H[self.perm][:, self.perm]
+
+        damp = self.percdamp * torch.mean(torch.diag(H))
+        diag = torch.arange(self.columns, device=self.dev)
+        H[diag, diag] += damp
+        H = torch.linalg.cholesky(H)
+        H = torch.cholesky_inverse(H)
+        H = torch.linalg.cholesky(H, upper=True)
+
+        # The actorder perm only depends on H, owq picks outliers per layer.
+        if not self.owq:
+            cache["Hinv"] = H
+        return H
+
     @torch.no_grad()
     def weight_transform(self, W, Hinv, Losses, tmp):
+        column_groups, group_qparams = self.get_column_groups()
         for i1 in range(0, self.n_nonout, self.blocksize):
             i2 = min(i1 + self.blocksize, self.n_nonout)
             count = i2 - i1
-            W1 = W[:, i1:i2].clone()
-            tmp1 = torch.zeros_like(W1)
-            Err1 = torch.zeros_like(W1)
-            Losses1 = torch.zeros_like(W1)
+            # Columns of the block are rows of W1, so the per-column quant and
+            # rank-1 updates below work on contiguous memory.
+            W1 = W[:, i1:i2].t().contiguous()
+            Err1 = torch.empty_like(W1)
+            Losses1 = torch.empty_like(W1)
             Hinv1 = Hinv[i1:i2, i1:i2]
             for i in range(count):
-                w = W1[:, i]
+                w = W1[i]
                 d = Hinv1[i, i]
 
-                if self.wquantizer.granularity == "per_group":
-                    idx = i1 + i
-                    if not self.static_groups:
-                        if (i1 + i) % self.wquantizer.group_size == 0:
-                            column_tensors = W[
-                                :,
-                                (i1 + i) : min(
-                                    (i1 + i + self.wquantizer.group_size),
-                                    (self.columns - self.n_out),
-                                ),
-                            ]
-                            self.search_column_qparams(column_tensors, idx)
-
-                    else:
-                        if self.actorder:
-                            idx = self.perm[idx]
-                        self.qparams = self.groups[idx // self.wquantizer.group_size]
+                if column_groups is not None:
+                    self.qparams = group_qparams[column_groups[i1 + i]]
+                elif self.wquantizer.granularity == "per_group":
+                    if (i1 + i) % self.wquantizer.group_size == 0:
+                        column_tensors = W[
+                            :,
+                            (i1 + i) : min(
+                                (i1 + i + self.wquantizer.group_size),
+                                (self.columns - self.n_out),
+                            ),
+                        ]
+                        self.search_column_qparams(column_tensors, i1 + i)
 
                 q = self.wquantizer.quant_dequant(
                     w.unsqueeze(1),
@@ -267,20 +277,38 @@ class GPTQ(BaseBlockwiseQuantization):
                     self.qparams["min_int"],
                 ).squeeze(1)
 
-                tmp1[:, i] = w
-
-                Losses1[:, i] = (w - q) ** 2 / d**2
+                Losses1[i] = (w - q) ** 2 / d**2
                 err1 = (w - q) / d
-                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
-                Err1[:, i] = err1
+                # Row i keeps the value it was quantized from, which is what
+                # the quantized weight is rebuilt from in w_qdq.
+                W1[i + 1 :] -= Hinv1[i, i + 1 :].unsqueeze(1) * err1
+                Err1[i] = err1
+
+            tmp[:, i1:i2] = W1.t()
+            Losses[:, i1:i2] = Losses1.t() / 2
+            # Lazy batch update, the rank-1 updates above stay in the block.
+            # Batching them in sub-blocks as well would sum the errors in
+            # another order and flip some roundings, so the quantized weights
+            # would no longer be identical to the column by column ones.
+            W[:, i2:] -= Err1.t().contiguous().matmul(Hinv[i1:i2, i2:])
 
-            tmp[:, i1:i2] = tmp1
-            Losses[:, i1:i2] = Losses1 / 2
-            W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
+    @torch.no_grad()
+    def get_column_groups(self):
+        # Static groups are known before the sweep, look up the group of every
+        # column once and share one qparams dict of views per group.
+        if self.wquantizer.granularity != "per_group" or not self.static_groups:
+            return None, None
+        columns = torch.arange(self.n_nonout)
+        if self.actorder:
+            columns = self.perm[: self.n_nonout].cpu()
+        column_groups = (columns // self.wquantizer.group_size).tolist()
+        n_groups = self.group_scales.shape[1]
+        return column_groups, [self.group_qparams(g) for g in range(n_groups)]
 
     @torch.no_grad()
     def cache_input_hook(self, m, inp, out, name, feat_dict):
-        self.add_batch(self.named_layers[name], name, inp[0].data, out.data)
+        if self.layers_cache[name]["owner"] == name:
+            self.add_batch(self.named_layers[name], name, inp[0].data, out.data)
 
     @torch.no_grad()
     def add_batch(self, layer, name, inp, out):
@@ -321,27 +349,44 @@ class GPTQ(BaseBlockwiseQuantization):
         )
         self.layers_cache[name]["nsamples"] = 0
         self.layers_cache[name]["columns"] = W.shape[1]
+        self.layers_cache[name]["owner"] = name
+
+    @torch.no_grad()
+    def subsets_init(self, subsets):
+        # Layers of a subset consume the same input, so they share one cache
+        # (H, nsamples and Hinv) that only the input layer accumulates.
+        shared = set()
+        for subset in subsets:
+            owner = subset["input"][0]
+            if owner not in subset["layers"]:
+                owner = next(iter(subset["layers"]))
+            self.layers_cache[owner] = {}
+            self.layer_init(subset["layers"][owner], owner)
+            for name in subset["layers"]:
+                self.layers_cache[name] = self.layers_cache[owner]
+                shared.add(name)
+
+        for name in self.named_layers:
+            if name not in shared:
+                self.layers_cache[name] = {}
+                self.layer_init(self.named_layers[name], name)
 
     @torch.no_grad()
     def subset_init(self, subset):
         self.named_layers = subset["layers"]
-        for name in self.named_layers:
-            self.layers_cache[name] = {}
-            self.layer_init(self.named_layers[name], name)
+        self.subsets_init([subset])
 
     @torch.no_grad()
     def block_init(self, block):
         self.named_layers = self.model.get_block_linears(block)
-        for name in self.named_layers:
-            self.layers_cache[name] = {}
-            self.layer_init(self.named_layers[name], name)
+        self.subsets_init(self.model.get_subsets_in_block(block))
 
     @torch.no_grad()
     def collect_model_qparams(self):
         for i in range(len(self.blocks)):
             named_linears = self.model.get_block_linears(self.blocks[i])
             for n, m in named_linears.items():
-                m.cuda()
+                m.to(self.dev)
                 m = m.float()
                 (
                     tensor,
@@ -357,17 +402,6 @@ class GPTQ(BaseBlockwiseQuantization):
                 m.register_buffer("buf_max_int", torch.tensor(max_int))
                 m.register_buffer("buf_min_int", torch.tensor(min_int))
 
-    @torch.no_grad()
-    def split_qparams(self, qparams):
-        group_qparams = []
-        group_num = self.columns // self.wquantizer.group_size
-        qparams = qparams.reshape(qparams.shape[0] // group_num, -1)
-        qparams = qparams.t()
-        group_qparams = list(torch.split(qparams, 1, dim=0))
-        for i in range(len(group_qparams)):
-            group_qparams[i] = group_qparams[i].reshape(-1, 1)
-        return group_qparams
-
     @torch.no_grad()
     def merge_qparams(self, qparams):
         if isinstance(qparams, int):
@@ -378,20 +412,27 @@ class GPTQ(BaseBlockwiseQuantization):
             qparams = qparams.repeat(head_size, 1)
             qparams = qparams.t()
             qparams = qparams.reshape(-1, 1)
-        elif self.wquantizer.granularity == "per_group":
-            qparams = torch.stack(qparams, dim=1)
-            qparams = qparams.reshape(-1, 1)
         return qparams
 
     @torch.no_grad()
     def search_column_qparams(self, c_tensor, idx):
-        _, scale, zero, max_int, min_int = self.wquantizer.get_tensor_qparams(c_tensor)
-        self.qparams["scale"] = scale
-        self.qparams["zero"] = zero
-        self.qparams["max_int"] = max_int
-        self.qparams["min_int"] = min_int
-        qparams = copy.deepcopy(self.qparams)
-        self.groups[idx // self.wquantizer.group_size] = qparams
+        g = idx // self.wquantizer.group_size
+        _, scale, zero, _, _ = self.wquantizer.get_tensor_qparams(c_tensor)
+        self.group_scales[:, g : g + 1] = scale
+        if self.group_zeros is not None:
+            self.group_zeros[:, g : g + 1] = zero
+        self.qparams = self.group_qparams(g)
+
+    @torch.no_grad()
+    def group_qparams(self, g):
+        # Views of the g-th column of the (rows, n_groups) qparams.
+        zeros = self.group_zeros
+        return {
+            "scale": self.group_scales[:, g : g + 1],
+            "zero": None if zeros is None else zeros[:, g : g + 1],
+            "max_int": self.group_max_int,
+            "min_int": self.group_min_int,
+        }
 
     @torch.no_grad()
     def search_layer_qparams(self, layer):
@@ -405,40 +446,31 @@ class GPTQ(BaseBlockwiseQuantization):
 
     @torch.no_grad()
     def search_group_qparams(self, layer):
-        scales = layer.buf_scales
-        zeros = layer.buf_zeros
-        self.group_scales = self.split_qparams(scales)
-        if zeros is not None:
-            self.group_zeros = self.split_qparams(zeros)
-        for i in range(len(self.group_scales)):
-            qparams = {}
-            qparams["scale"] = self.group_scales[i]
-            if zeros is not None:
-                qparams["zero"] = self.group_zeros[i]
-            else:
-                qparams["zero"] = None
-            qparams["max_int"] = layer.buf_max_int
-            qparams["min_int"] = layer.buf_min_int
-            self.groups.append(qparams)
+        # buf_* hold the qparams of group g of row r at r * n_groups + g, so
+        # they are (rows, n_groups) tensors the column sweep writes in place.
+        n_groups = self.columns // self.wquantizer.group_size
+        self.group_scales = layer.buf_scales.reshape(-1, n_groups).clone()
+        self.group_zeros = None
+        if layer.buf_zeros is not None:
+            self.group_zeros = layer.buf_zeros.reshape(-1, n_groups).clone()
+        self.group_max_int = layer.buf_max_int
+        self.group_min_int = layer.buf_min_int
 
     @torch.no_grad()
     def update_model_qparams(self, layer):
-        _scales = []
-        _zeros = []
-        for g in self.groups:
-            _scales.append(g["scale"])
-            _zeros.append(g["zero"])
-        scales = self.merge_qparams(_scales)
-        zeros = self.merge_qparams(_zeros)
-        layer.buf_scales = copy.deepcopy(scales)
-        layer.buf_zeros = copy.deepcopy(zeros)
+        layer.buf_scales = self.group_scales.reshape(-1, 1)
+        if self.group_zeros is not None:
+            layer.buf_zeros = self.group_zeros.reshape(-1, 1)
 
     @torch.no_grad()
     def w_q(self, module):
         weight = module.weight.data
         args = {}
         args["scales"] = module.buf_scales
-        args["zeros"] = module.buf_zeros
+        if hasattr(module, "buf_zeros"):
+            args["zeros"] = module.buf_zeros
+        else:
+            args["zeros"] = None
         args["max_int"] = module.buf_max_int
         args["min_int"] = module.buf_min_int
         args["scales"] = args["scales"].to(self.model_dtype)
@@ -496,7 +528,7 @@ class GPTQ(BaseBlockwiseQuantization):
         self.Losses = None
         self.Trace = None
         del self.layers_cache[name]
-        torch.cuda.empty_cache()
+        empty_cache()
 
     @torch.no_grad()
     def ready(self):
@@ -2,15 +2,20 @@ import torch
 import torch.nn as nn
 from loguru import logger
 import gc
+from collections import defaultdict
 from transformers.models.llama.modeling_llama import LlamaRMSNorm
 from transformers.models.mistral.modeling_mistral import MistralRMSNorm
 from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
 from .module_utils import FakeQuantLinear
+from .layer_pool import LayerPool
+from llmc.utils.device import get_device, empty_cache
 
 
 @ALGO_REGISTRY
 class HQQ(BaseBlockwiseQuantization):
+    parallel_layers = True
+
     def __init__(self, model, quant_config, input=None, config=None):
         super().__init__(model, quant_config, input, config)
         self.add_quant_config()
@@ -22,6 +27,8 @@ class HQQ(BaseBlockwiseQuantization):
         self.kappa = self.quant_config["special"]["kappa"]
         self.iters = self.quant_config["special"]["iters"]
         self.axis = self.quant_config["special"]["axis"]
+        self.batch_blocks = self.quant_config["special"].get("batch_blocks", 1)
+        self.patience = self.quant_config["special"].get("patience", 2)
         if self.lp_norm == 1:
             self.shrink_op = lambda x, beta: torch.sign(x) * torch.nn.functional.relu(
                 torch.abs(x) - 1.0 / self.beta
@@ -35,63 +42,160 @@ class HQQ(BaseBlockwiseQuantization):
 
     @torch.no_grad()
     def optimize_weights_proximal(self, W_f, scales, zeros, max_int, min_int):
-        best_error = 1e4
+        # Rows are independent, each one stops once its own error has not
+        # improved for ``patience`` iterations and keeps its best zeros.
+        n = W_f.shape[0]
+        inv_scales = 1 / scales
+        s = inv_scales.expand(n, 1)
+        z = zeros.expand(n, 1)
+        W = W_f
+        rows = torch.arange(n, device=W_f.device)
+        best_zeros = z.clone()
+        best_error = torch.full((n,), float("inf"), device=W_f.device)
+        stale = torch.zeros(n, dtype=torch.int32, device=W_f.device)
+        active = torch.ones(n, dtype=torch.bool, device=W_f.device)
+        out_zeros, out_error = best_zeros.clone(), best_error.clone()
         current_beta = self.beta
-        current_kappa = self.kappa
-        scales = 1 / scales
-        for i in range(self.iters):
-            W_q = torch.round(W_f * scales + zeros).clamp(min_int, max_int)
-            W_r = (W_q - zeros) / scales
-            W_e = self.shrink_op(W_f - W_r, current_beta)
-
-            zeros = torch.mean(W_q - (W_f - W_e) * scales, axis=-1, keepdim=True)
-            current_beta *= current_kappa
-            current_error = float(torch.abs(W_f - W_r).mean())
-
-            logger.info(f"iter : {i}, error : {current_error}")
-
-            if current_error < best_error:
-                best_error = current_error
-            else:
+        for i in range(self.iters + 1):
+            W_q = torch.round(W * s + z).clamp(min_int, max_int)
+            W_r = (W_q - z) / s
+            error = torch.abs(W - W_r).mean(-1)
+            improved = active & (error < best_error)
+            best_error = torch.where(improved, error, best_error)
+            best_zeros = torch.where(improved[:, None], z, best_zeros)
+            stale = torch.where(improved, 0, stale + 1)
+            active &= stale < self.patience
+            if i == self.iters:
+                break
+            n_active = int(active.sum())
+            if n_active == 0:
                 break
+            if n_active <= len(rows) // 2:
+                out_zeros[rows], out_error[rows] = best_zeros, best_error
+                rows, W, W_q, W_r, s, z, best_zeros, best_error, stale = (
+                    t[active]
+                    for t in (rows, W, W_q, W_r, s, z, best_zeros, best_error, stale)
+                )
+                active = active[active]
+
+            W_e = self.shrink_op(W - W_r, current_beta)
+            z = torch.mean(W_q - (W - W_e) * s, axis=-1, keepdim=True)
+            current_beta *= self.kappa
+        out_zeros[rows], out_error[rows] = best_zeros, best_error
+        logger.info(f"iters : {i}, error : {float(out_error.mean())}")
+
+        empty_cache()
+        return 1 / inv_scales, out_zeros
+
+    def run_block_loop(self, resume=False):
+        # Only the block by block loop checkpoints its progress.
+        assert not (resume and (self.num_workers or self.batch_blocks > 1)), (
+            "HQQ can not resume with num_workers or batch_blocks."
+        )
+        if self.num_workers:
+            # No activations are needed, so the linears of all blocks are
+            # optimized at once in a pool of workers.
+            layers = [
+                (idx, name, layer)
+                for idx, block in enumerate(self.blocks)
+                for name, layer in self.model.get_block_linears(block).items()
+            ]
+            with LayerPool(self, self.num_workers) as pool:
+                results = pool.imap("optimize_layer", [layer for *_, layer in layers])
+                for (idx, name, layer), qparams in zip(layers, results):
+                    logger.info(f"Optimized weights proximal of {name} in block {idx}")
+                    self.register_qparams(layer, qparams)
+        elif self.batch_blocks > 1:
+            for start in range(0, len(self.blocks), self.batch_blocks):
+                end = min(start + self.batch_blocks, len(self.blocks))
+                logger.info(f"Optimize blocks {start+1}-{end}/{len(self.blocks)}")
+                self.blocks_opt(self.blocks[start:end])
+        else:
+            super().run_block_loop(resume)
 
-        torch.cuda.empty_cache()
-        scales = 1 / scales
+    @torch.no_grad()
+    def block_opt(self, block, idx):
+        self.blocks_opt([block])
 
-        return scales, zeros
+    @torch.no_grad()
+    def blocks_opt(self, blocks):
+        layers = []
+        for block in blocks:
+            self.onload_block(block)
+            named_linears = self.model.get_block_linears(block)
+            logger.info(f"named_linears: {named_linears}")
+            layers.extend(named_linears.values())
+
+        for layer, qparams in zip(layers, self.optimize_layers(layers)):
+            self.register_qparams(layer, qparams)
+
+        for block in blocks:
+            self.offload_block(block)
+        gc.collect()
+        empty_cache()
 
     @torch.no_grad()
-    def block_opt(self, block, idx):
-        block = block.cuda()
-        named_linears = self.model.get_block_linears(block)
-        logger.info(f"named_linears: {named_linears}")
-
-        for name in named_linears:
-            logger.info(f"Optimize weights proximal of {name}")
-            layer = named_linears[name]
-
-            tensor = layer.weight.data.float()
-            if self.axis == 0:
-                tensor = tensor.T
-            (
-                tensor,
-                org_scales,
-                org_zeros,
-                max_int,
-                min_int,
-            ) = self.wquantizer.get_tensor_qparams(tensor)
-
-            best_scales, best_zeros = self.optimize_weights_proximal(
-                tensor, org_scales, org_zeros, max_int, min_int
+    def optimize_layer(self, layer):
+        return self.optimize_layers([layer])[0]
+
+    @torch.no_grad()
+    def optimize_layers(self, layers):
+        # Linears whose rows have the same width are solved as one problem,
+        # packed in chunks no larger than the biggest of them.
+        shapes = []
+        for layer in layers:
+            shape = layer.weight.shape if self.axis == 1 else layer.weight.shape[::-1]
+            meta = torch.empty(shape, device="meta")
+            shapes.append(self.wquantizer.reshape_tensor(meta).shape)
+        groups = defaultdict(list)
+        for i, shape in enumerate(shapes):
+            groups[shape[-1]].append(i)
+        chunks = []
+        for indices in groups.values():
+            max_rows = max(shapes[i][0] for i in indices)
+            chunk, rows = [], 0
+            for i in indices:
+                if chunk and rows + shapes[i][0] > max_rows:
+                    chunks.append(chunk)
+                    chunk, rows = [], 0
+                chunk.append(i)
+                rows += shapes[i][0]
+            chunks.append(chunk)
+
+        qparams = [None] * len(layers)
+        for chunk in chunks:
+            tensors, scales, zeros = [], [], []
+            for i in chunk:
+                tensor = layers[i].weight.data.float()
+                if self.axis == 0:
+                    tensor = tensor.T
+                (
+                    tensor,
+                    org_scales,
+                    org_zeros,
+                    max_int,
+                    min_int,
+                ) = self.wquantizer.get_tensor_qparams(tensor)
+                tensors.append(tensor)
+                scales.append(org_scales.expand(tensor.shape[0], 1))
+                zeros.append(org_zeros.expand(tensor.shape[0], 1))
+                qparams[i] = {
+                    # Not org_scales: the baseline round trips through inv_scales.
+                    "buf_scales": 1 / (1 / org_scales),
+                    "buf_max_int": torch.tensor(max_int),
+                    "buf_min_int": torch.tensor(min_int),
+                }
+            _, best_zeros = self.optimize_weights_proximal(
+                torch.cat(tensors), torch.cat(scales), torch.cat(zeros), max_int, min_int
             )
-            layer.register_buffer("buf_scales", best_scales)
-            layer.register_buffer("buf_zeros", best_zeros)
-            layer.register_buffer("buf_max_int", torch.tensor(max_int))
-            layer.register_buffer("buf_min_int", torch.tensor(min_int))
+            best_zeros = best_zeros.split([shapes[i][0] for i in chunk])
+            for i, z in zip(chunk, best_zeros):
+                qparams[i]["buf_zeros"] = z.clone()
+        return qparams
 
-        block = block.cpu()
-        gc.collect()
-        torch.cuda.empty_cache()
+    def register_qparams(self, layer, qparams):
+        for name, tensor in qparams.items():
+            layer.register_buffer(name, tensor)
 
     def w_qdq(self, module):
         args = {}
@@ -103,3 +207,13 @@ class HQQ(BaseBlockwiseQuantization):
         args["min_int"] = module.buf_min_int
 
         return self.wquantizer.fake_quant_weight_static(module.weight, args)
+
+    def w_q(self, module):
+        assert self.axis == 1, "real_quant needs qparams along output channels."
+        args = {}
+        args["scales"] = module.buf_scales
+        args["zeros"] = module.buf_zeros
+        args["max_int"] = module.buf_max_int
+        args["min_int"] = module.buf_min_int
+
+        return self.wquantizer.real_quant_weight_static(module.weight.data, args)
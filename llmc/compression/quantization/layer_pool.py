@@ -0,0 +1,82 @@
+import multiprocessing
+import torch
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+_worker_algo = None
+
+
+def _init_worker(algo):
+    global _worker_algo
+    _worker_algo = algo
+    # OpenMP is not fork-safe once the parent used it, keep workers single-threaded.
+    torch.set_num_threads(1)
+
+
+@torch.no_grad()
+def _call(fn_name, layer):
+    return getattr(_worker_algo, fn_name)(layer)
+
+
+def _share(tensor):
+    return torch.empty_like(tensor).share_memory_().copy_(tensor)
+
+
+def _unshare(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.clone()
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_unshare(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _unshare(v) for k, v in obj.items()}
+    return obj
+
+
+class LayerPool:
+    """
+    Runs a method of ``algo`` on many linears in ``num_workers`` forked
+    processes. A worker sees each linear as a stand-in holding shared-memory
+    copies of its weight and ``buf_*`` qparams, and its results are copied
+    back in input order.
+    """
+
+    def __init__(self, algo, num_workers):
+        self.num_workers = num_workers
+        self.executor = ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(algo,),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    @staticmethod
+    def stand_in(layer):
+        tensors = {"weight": layer.weight.data}
+        for name, buf in layer.named_buffers(recurse=False):
+            if name.startswith("buf_"):
+                tensors[name] = buf
+        return SimpleNamespace(**{k: _share(v) for k, v in tensors.items()})
+
+    def imap(self, fn_name, layers):
+        # Keeps a few linears per worker in flight to bound the shared memory.
+        pending = deque()
+        for layer in layers:
+            pending.append(
+                self.executor.submit(_call, fn_name, self.stand_in(layer))
+            )
+            if len(pending) >= 2 * self.num_workers:
+                yield _unshare(pending.popleft().result())
+        while pending:
+            yield _unshare(pending.popleft().result())
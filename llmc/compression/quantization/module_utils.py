@@ -1,7 +1,16 @@
 import torch
 import torch.nn as nn
-import gc
+import weakref
 from functools import partial
+from llmc.utils.device import get_device, empty_cache
+from .pack import pack_tensor, unpack_tensor
+
+
+def copy_qparams(src, dst):
+    # Share the buf_* qparams of src with dst, views of a QParamStore included.
+    for name, buf in src.named_buffers(recurse=False):
+        if name.startswith("buf_"):
+            dst.register_buffer(name, buf.data)
 
 
 class LlmcLayerNorm(nn.Module):
@@ -102,9 +111,7 @@ class OriginFloatLinear(nn.Module):
         else:
             self.bias = None
 
-        for name, buf in ori_module.named_buffers():
-            if name.startswith("buf_"):
-                self.register_buffer(name, buf.data)
+        copy_qparams(ori_module, self)
 
     @torch.no_grad()
     def forward(self, x):
@@ -144,12 +151,11 @@ class FakeQuantLinear(nn.Module):
         self.a_qdq = a_qdq
         self.w_qdq = w_qdq
 
-        for name, buf in ori_module.named_buffers():
-            if name.startswith("buf_"):
-                self.register_buffer(name, buf.data)
+        copy_qparams(ori_module, self)
 
         self.dynamic_quant_weight = False
         self.dynamic_quant_tmp_weight = False
+        self.weight_version = None
 
     def forward(self, x):
         if self.a_qdq is not None:
@@ -159,18 +165,56 @@ class FakeQuantLinear(nn.Module):
             tmp_weight = self.w_qdq(self)
             self.register_buffer("tmp_weight", tmp_weight, persistent=False)
             self.tmp_bias = self.bias
+            self.weight_version = None
 
         elif self.dynamic_quant_weight:
-            self.tmp_weight = self.w_qdq(self)
-            self.tmp_bias = self.bias
+            if not self.weight_cached():
+                self.tmp_weight = self.w_qdq(self)
+                self.tmp_bias = self.bias
+                self.weight_version = self.get_weight_version()
 
         elif self.dynamic_quant_tmp_weight:
-            self.tmp_weight = self.w_qdq(self)
+            if not self.weight_cached():
+                self.tmp_weight = self.w_qdq(self)
+                self.weight_version = self.get_weight_version()
 
         x = torch.functional.F.linear(x, self.tmp_weight, self.tmp_bias)
 
         return x
 
+    def weight_inputs(self):
+        # What w_qdq reads besides tmp_weight: the weight (unless it quantizes
+        # tmp_weight) and the buf_* tensors, e.g. the learnable bound factors.
+        tensors = [] if self.dynamic_quant_tmp_weight else [self.weight]
+        for name, t in list(self._parameters.items()) + list(self._buffers.items()):
+            if name.startswith("buf_") and t is not None:
+                tensors.append(t)
+        return tensors
+
+    def get_weight_version(self):
+        # Weak refs, storage and version counter of the fake-quantized weight
+        # and of its inputs. In-place updates (e.g. an optimizer step) bump the
+        # version counter, assigning .data moves the storage.
+        return [
+            (weakref.ref(t), t.data_ptr(), t._version)
+            for t in [self.tmp_weight] + self.weight_inputs()
+        ]
+
+    def weight_cached(self):
+        # tmp_weight is reused while neither it nor its inputs changed. A
+        # forward that builds a graph through learnable inputs recomputes it.
+        if self.weight_version is None:
+            return False
+        tensors = [self.tmp_weight] + self.weight_inputs()
+        if len(tensors) != len(self.weight_version):
+            return False
+        if torch.is_grad_enabled() and any(t.requires_grad for t in tensors):
+            return False
+        return all(
+            ref() is t and t.data_ptr() == ptr and t._version == version
+            for t, (ref, ptr, version) in zip(tensors, self.weight_version)
+        )
+
     @classmethod
     @torch.no_grad()
     def new(cls, module, w_qdq, a_qdq):
@@ -213,9 +257,7 @@ class EffcientFakeQuantLinear(nn.Module):
             self.bias = None
         self.a_qdq = a_qdq
 
-        for name, buf in ori_module.named_buffers():
-            if name.startswith("buf_"):
-                self.register_buffer(name, buf.data)
+        copy_qparams(ori_module, self)
 
     @torch.no_grad()
     def forward(self, x):
@@ -267,11 +309,53 @@ class RealQuantLinear(nn.Module):
         if zeros is not None:
             self.register_buffer("zeros", zeros)
         else:
-            self.zero = None
+            self.zeros = None
+
+    # Rows of the weight dequantized at a time in forward.
+    tile_size = 256
+
+    @torch.no_grad()
+    def dequant_weight(self, start, end):
+        n = 32 // self.bit
+        scales = self.scales[start:end]
+        if self.weight.dtype == torch.int32:
+            weight = unpack_tensor(
+                self.weight[start:end], self.bit, dim=1, dtype=torch.uint8
+            )
+        else:
+            weight = self.weight[start:end]
+
+        if self.zeros is None and weight.dtype == torch.uint8:
+            # Symmetric weights unpack as two's complement fields, flipping the
+            # sign bit offsets them by a constant zero point.
+            weight = weight.bitwise_xor_(2 ** (self.bit - 1))
+            zeros = torch.full_like(scales, 2 ** (self.bit - 1))
+        elif self.zeros is None:
+            zeros = torch.zeros_like(scales)
+        elif self.zeros.dtype == torch.int32:
+            zeros = unpack_tensor(self.zeros[start // n : end // n], self.bit, dim=0)
+        else:
+            zeros = self.zeros[start:end]
+
+        # (q - z) * s as q * s - z * s in one pass over the tile.
+        zeros = zeros.to(scales.dtype)
+        weight = weight.view(end - start, scales.shape[1], -1)
+        weight = torch.addcmul(
+            (-zeros * scales).unsqueeze(-1), weight, scales.unsqueeze(-1)
+        )
+        return weight.view(end - start, -1)
 
     @torch.no_grad()
     def forward(self, x):
-        raise NotImplementedError
+        out = []
+        for start in range(0, self.out_features, self.tile_size):
+            end = min(start + self.tile_size, self.out_features)
+            weight = self.dequant_weight(start, end).to(x.dtype)
+            out.append(torch.functional.F.linear(x, weight))
+        out = torch.cat(out, dim=-1)
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
 
     @classmethod
     @torch.no_grad()
@@ -285,6 +369,7 @@ class RealQuantLinear(nn.Module):
         new_module = cls(weight, bias, scales, zeros)
         new_module.in_features = module.in_features
         new_module.out_features = module.out_features
+        new_module.bit = quant_config["weight"]["bit"]
         new_module.weight_shape = weight.shape
         new_module.weight_dtype = weight.dtype
         new_module.scales_shape = scales.shape
@@ -331,32 +416,21 @@ class RealQuantLinear(nn.Module):
         assert h1 % tmp == 0 and h2 % tmp == 0, "H1 {} H2 {}".format(h1, h2)
         assert h2 % group_size == 0, "H1 {} H2 {}".format(h1, h2)
 
-        weight = weight.cuda()
-        int_weight = torch.empty(h1, h2 // tmp).to(torch.int32).cuda()
         # Weight pack in row.
-        for pack in range(0, h2, tmp):
-            for i in range(tmp):
-                int_weight[:, pack // tmp] += weight[:, pack + i] << (i * bit)
-        weight = weight.cpu()
-        int_weight = int_weight.cpu()
-        del weight
+        int_weight = pack_tensor(weight.to(get_device()), bit, dim=1).cpu()
 
-        if zeros is not None:
-            zeros = zeros.cuda()
-            int_zeros = torch.zeros(h1 // tmp, h2 // group_size).to(torch.int32).cuda()
-            zeros = zeros.view(h1, -1)
+        if zeros is not None and not zeros.is_floating_point():
             # zero point pack in col.
-            for pack in range(0, h1, tmp):
-                for i in range(tmp):
-                    int_zeros[pack // tmp, :] += zeros[pack + i, :] << (i * bit)
-            zeros = zeros.cpu()
-            int_zeros = int_zeros.cpu()
-            del zeros
+            zeros = zeros.to(get_device()).view(h1, -1)
+            int_zeros = pack_tensor(zeros, bit, dim=0).cpu()
+        elif zeros is not None:
+            # Zero points are not rounded (round_zp is False), keep them in float.
+            int_zeros = zeros.view(h1, -1)
         else:
             int_zeros = None
 
-        gc.collect()
-        torch.cuda.empty_cache()
+        del weight, zeros
+        empty_cache()
 
         scales = scales.view(h1, -1)
         return int_weight, scales, int_zeros
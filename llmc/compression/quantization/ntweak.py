@@ -19,12 +19,14 @@ from .module_utils import (
 )
 from .train_utils import NativeScalerWithGradNormCount, LossFunction
 from llmc.utils.registry_factory import ALGO_REGISTRY
+from llmc.utils.device import get_device, get_autocast_dtype, autocast
 
 
 @ALGO_REGISTRY
 class NormTweaking(BaseBlockwiseQuantization):
     def __init__(self, model, quant_config, input, config):
         super().__init__(model, quant_config, input, config)
+        self.model_dtype = next(self.model.model.parameters()).dtype
         self.add_quant_config()
 
         if self.config["model"]["type"] == "Llama":
@@ -34,8 +36,7 @@ class NormTweaking(BaseBlockwiseQuantization):
             self.attention_mask = self.input["kwargs"][0]["attention_mask"]
             self.position_ids = None
 
-        self.dev = torch.device("cuda")
-        self.model_dtype = next(self.model.model.parameters()).dtype
+        self.dev = get_device()
 
     def add_quant_config(self):
         self.prefix = self.model.block_name_prefix
@@ -46,35 +47,54 @@ class NormTweaking(BaseBlockwiseQuantization):
             self.dtype = torch.float
             self.traincast = nullcontext
         else:
-            self.dtype = self.model_dtype
-            self.traincast = torch.cuda.amp.autocast
+            # float16 autocast trains in the model dtype with loss scaling,
+            # bfloat16 (cpu) trains float32 parameters without a scaler.
+            if get_autocast_dtype() == torch.float16:
+                self.dtype = self.model_dtype
+            else:
+                self.dtype = torch.float
+            self.traincast = autocast
         self.epochs = self.quant_config["special"]["epochs"]
         self.ntweak_lr = self.quant_config["special"]["ntweak_lr"]
         self.gamma = self.quant_config["special"]["gamma"]
+        ref_dtype = self.quant_config["special"].get("ref_dtype", None)
+        self.ref_dtype = eval(ref_dtype) if isinstance(ref_dtype, str) else ref_dtype
 
-    def block_forward(self, block, input_data=None):
-        output = []
+    def block_forward(self, block, input_data=None, ref=False):
+        # Inputs stay where they are kept and are moved to the device one
+        # sample at a time. Reference outputs (the training targets) are
+        # kept on cpu, or in the act_store, in ref_dtype.
+        output = self.new_tensor_list()
 
         if input_data is None:
             input_data = self.input["data"]
 
         for i in range(len(input_data)):
-            input_data[i] = input_data[i].to(device=next(block.parameters()).device)
+            x = input_data[i].to(device=next(block.parameters()).device)
+            if ref:
+                x = x.to(self.dtype)
             if "attention_mask" in self.input["kwargs"][i]:
                 self.input["kwargs"][i]["attention_mask"] = self.input["kwargs"][i][
                     "attention_mask"
-                ].cuda()
+                ].to(get_device())
             with torch.no_grad():
-                with torch.cuda.amp.autocast():
-                    out = block(input_data[i], **self.input["kwargs"][i])[0]
-                    output.append(out)
+                with autocast():
+                    out = block(x, **self.input["kwargs"][i])[0]
+                if ref:
+                    out = out.to(device="cpu", dtype=self.ref_dtype)
+                output.append(out)
         return output
 
     def get_original_out(self, block, idx):
         if idx == 0:
-            self.ori_out = self.block_forward(block)
+            self.ori_out = self.block_forward(block, ref=True)
         else:
-            self.ori_out = self.block_forward(block, self.ori_out)
+            self.ori_out = self.block_forward(block, self.ori_out, ref=True)
+
+    def ckpt_tensor_lists(self):
+        tensor_lists = super().ckpt_tensor_lists()
+        tensor_lists["ori_out"] = self.ori_out
+        return tensor_lists
 
     def block_transform(self, block, input_feat, idx, block_kwargs):
         logger.info(f"Start transform the {idx+1}-th block")
@@ -100,7 +120,7 @@ class NormTweaking(BaseBlockwiseQuantization):
         for param_group in optimizer.param_groups:
             logger.info(param_group["lr"])
 
-        loss_scaler = NativeScalerWithGradNormCount()
+        loss_scaler = NativeScalerWithGradNormCount(enabled=not self.deactive_amp)
 
         for i in range(len(self.input["data"])):
             if self.deactive_amp:
@@ -121,12 +141,12 @@ class NormTweaking(BaseBlockwiseQuantization):
             norm_list = []
 
             for i in range(len(self.input["data"])):
+                x = self.input["data"][i].to(self.dev)
+                ori_out = self.ori_out[i].to(self.dev, self.dtype)
                 with self.traincast():
-                    quant_out = block(self.input["data"][i], **self.input["kwargs"][i])[
-                        0
-                    ]
+                    quant_out = block(x, **self.input["kwargs"][i])[0]
 
-                    loss = self.loss_func(self.ori_out[i].to(self.dtype), quant_out)
+                    loss = self.loss_func(ori_out, quant_out)
 
                 if not math.isfinite(loss.item()):
                     logger.info("Loss is NAN, stopping training")
@@ -22,12 +22,15 @@ from .module_utils import (
 )
 from .train_utils import NativeScalerWithGradNormCount, TruncateFunction, LossFunction
 from llmc.utils.registry_factory import ALGO_REGISTRY
+from llmc.utils.device import get_device, get_autocast_dtype, empty_cache, autocast
+from llmc.utils.tracer import tracer
 
 
 @ALGO_REGISTRY
 class OmniQuant(BaseBlockwiseQuantization):
     def __init__(self, model, quant_config, input, config):
         super().__init__(model, quant_config, input, config)
+        self.model_dtype = next(self.model.model.parameters()).dtype
         self.add_quant_config()
 
         if self.config["model"]["type"] not in ["Llama", "Opt", "Falcon", "Mistral"] and self.let:
@@ -42,15 +45,14 @@ class OmniQuant(BaseBlockwiseQuantization):
         if self.deactive_amp:
             self.batch_mask = self.attention_mask.repeat(
                 self.input["data"][0].shape[0], 1, 1, 1
-            ).cuda()
+            ).to(get_device())
         else:
             self.batch_mask = (
-                self.attention_mask.repeat(self.input["data"][i].shape[0], 1, 1, 1)
+                self.attention_mask.repeat(self.input["data"][0].shape[0], 1, 1, 1)
                 .float()
-                .cuda()
+                .to(get_device())
             )
-        self.dev = torch.device("cuda")
-        self.model_dtype = next(self.model.model.parameters()).dtype
+        self.dev = get_device()
 
     def add_quant_config(self):
         self.prefix = self.model.block_name_prefix
@@ -62,8 +64,13 @@ class OmniQuant(BaseBlockwiseQuantization):
             self.dtype = torch.float
             self.traincast = nullcontext
         else:
-            self.dtype = self.model_dtype
-            self.traincast = torch.cuda.amp.autocast
+            # float16 autocast trains in the model dtype with loss scaling,
+            # bfloat16 (cpu) trains float32 parameters without a scaler.
+            if get_autocast_dtype() == torch.float16:
+                self.dtype = self.model_dtype
+            else:
+                self.dtype = torch.float
+            self.traincast = autocast
 
         self.epochs = self.quant_config["special"]["epochs"]
         self.aug_loss = self.quant_config["special"]["aug_loss"]
@@ -93,33 +100,57 @@ class OmniQuant(BaseBlockwiseQuantization):
         if self.epochs > 0:
             assert self.lwc or self.let
 
-    def block_forward(self, block, input_data=None):
-        output = []
+        ref_dtype = self.quant_config["special"].get("ref_dtype", None)
+        self.ref_dtype = eval(ref_dtype) if isinstance(ref_dtype, str) else ref_dtype
+
+    def block_forward(self, block, input_data=None, ref=False):
+        # Inputs stay where they are kept and are moved to the device one
+        # sample at a time. Reference outputs (the training targets) are
+        # kept on cpu, or in the act_store, in ref_dtype.
+        output = self.new_tensor_list()
 
         if input_data is None:
             input_data = self.input["data"]
 
         for i in range(len(input_data)):
-            input_data[i] = input_data[i].to(device=next(block.parameters()).device)
+            x = input_data[i].to(device=next(block.parameters()).device)
+            if ref:
+                x = x.to(self.dtype)
             if "attention_mask" in self.input["kwargs"][i]:
                 self.input["kwargs"][i]["attention_mask"] = self.input["kwargs"][i][
                     "attention_mask"
-                ].cuda()
+                ].to(get_device())
             with torch.no_grad():
-                with torch.cuda.amp.autocast():
-                    out = block(input_data[i], **self.input["kwargs"][i])[0]
-                    output.append(out)
+                with autocast():
+                    out = block(x, **self.input["kwargs"][i])[0]
+                if ref:
+                    out = out.to(device="cpu", dtype=self.ref_dtype)
+                output.append(out)
         return output
 
     def get_original_out(self, block, idx):
         if idx == 0:
-            self.ori_out = self.block_forward(block)
+            self.ori_out = self.block_forward(block, ref=True)
             if self.aug_loss:
                 self.ori_out2 = self.ori_out
         else:
-            self.ori_out = self.block_forward(block, self.ori_out)
+            self.ori_out = self.block_forward(block, self.ori_out, ref=True)
             if self.aug_loss:
-                self.ori_out2 = self.block_forward(block)
+                self.ori_out2 = self.block_forward(block, ref=True)
+
+    def ckpt_tensor_lists(self):
+        tensor_lists = super().ckpt_tensor_lists()
+        tensor_lists["ori_out"] = self.ori_out
+        if self.aug_loss:
+            tensor_lists["ori_out2"] = self.ori_out2
+        return tensor_lists
+
+    def load_block_state(self, block, idx, state_dict):
+        params_dict = {}
+        params_dict["a_qdq"] = self.a_qdq if not self.w_only else None
+        params_dict["w_qdq"] = self.w_qdq
+        self.model.replace_module_block(FakeQuantLinear, block, idx, params_dict)
+        super().load_block_state(block, idx, state_dict)
 
     def block_transform(self, block, input_feat, idx, block_kwargs):
         logger.info(f"Start transform the {idx+1}-th block")
@@ -165,31 +196,32 @@ class OmniQuant(BaseBlockwiseQuantization):
                 weight_decay=self.wd,
             )
 
-        loss_scaler = NativeScalerWithGradNormCount()
+        loss_scaler = NativeScalerWithGradNormCount(enabled=not self.deactive_amp)
 
         for epochs in range(self.epochs):
             loss_list = []
             norm_list = []
 
             for i in range(len(self.input["data"])):
+                x = self.input["data"][i].to(self.dev)
+                ori_out = self.ori_out[i].to(self.dev, self.dtype)
                 with self.traincast():
                     if self.let:
                         self.smooth_weight_tmp(block)
 
                     if self.position_ids is not None:
                         quant_out = block(
-                            self.input["data"][i],
+                            x,
                             attention_mask=self.batch_mask,
                             position_ids=self.position_ids,
                         )[0]
                     else:
-                        quant_out = block(
-                            self.input["data"][i], attention_mask=self.batch_mask
-                        )[0]
+                        quant_out = block(x, attention_mask=self.batch_mask)[0]
 
-                    loss = self.loss_func(self.ori_out[i], quant_out)
+                    loss = self.loss_func(ori_out, quant_out)
                     if self.aug_loss:
-                        loss += self.loss_func(self.ori_out2[i], quant_out)
+                        ori_out2 = self.ori_out2[i].to(self.dev, self.dtype)
+                        loss += self.loss_func(ori_out2, quant_out)
 
                 if not math.isfinite(loss.item()):
                     logger.info("Loss is NAN, stopping training")
@@ -404,18 +436,20 @@ class OmniQuant(BaseBlockwiseQuantization):
         with torch.no_grad():
             for i in tqdm(range(len(self.blocks))):
                 block = self.blocks[i]
-                block.cuda()
+                block.to(get_device())
+                tracer.add_module_bytes(block)
                 if i == 0:
                     fp_inps = self.block_forward(block)
                 else:
                     fp_inps = self.block_forward(block, fp_inps)
 
+                tracer.add_module_bytes(block)
                 block.cpu()
 
         for h in hooks:
             h.remove()
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
 
         return act_stat
 
@@ -584,6 +618,14 @@ class OmniQuant(BaseBlockwiseQuantization):
         else:
             return self.wquantizer.fake_quant_weight_dynamic(module.weight, args)
 
+    def w_q(self, module):
+        args = {}
+        if hasattr(module, "buf_upbound_factor"):
+            args["lowbound_factor"] = module.buf_lowbound_factor
+            args["upbound_factor"] = module.buf_upbound_factor
+
+        return self.wquantizer.real_quant_weight_dynamic(module.weight.data, args)
+
     def deploy(self, quant_format):
         super().deploy(quant_format)
         self.model.convert_dtype(self.model_dtype)
@@ -8,7 +8,7 @@ from transformers.models.mistral.modeling_mistral import MistralRMSNorm
 from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
 from .module_utils import FakeQuantLinear
-from collections import defaultdict
+from llmc.utils.device import empty_cache
 
 
 @ALGO_REGISTRY
@@ -32,7 +32,7 @@ class OsPlus(BaseBlockwiseQuantization):
         name_list = list(named_linears.keys())
 
         for index, subset in enumerate(subsets):
-            input_feat_subset = defaultdict(list)
+            input_feat_subset = self.new_feat_dict()
             handles = []
             for name in name_list:
                 handles.append(
@@ -68,7 +68,7 @@ class OsPlus(BaseBlockwiseQuantization):
             self.model.replace_module_subset(
                 FakeQuantLinear, block, subset, idx, params_dict
             )
-        torch.cuda.empty_cache()
+        empty_cache()
         logger.info(f"End transform the {idx+1}-th block")
 
     @torch.no_grad()
@@ -208,7 +208,7 @@ class OsPlus(BaseBlockwiseQuantization):
 
             del org_out_dict
             gc.collect()
-            torch.cuda.empty_cache()
+            empty_cache()
             return best_scale, shift
 
     @torch.no_grad()
@@ -0,0 +1,51 @@
+import sys
+import torch
+
+
+def pack_tensor(tensor, bit, dim=-1):
+    """
+    Pack ``32 // bit`` consecutive integers along ``dim`` into one int32,
+    the i-th one in bits [i * bit, (i + 1) * bit). Negative values are
+    stored in two's complement, use ``unpack_tensor(..., signed=True)``.
+    """
+    assert bit in (1, 2, 4, 8), f"Can not pack {bit}-bit integers in int32."
+    n, k = 32 // bit, 8 // bit
+    tensor = tensor.movedim(dim, -1).contiguous()
+    assert tensor.shape[-1] % n == 0, f"Dim {tensor.shape[-1]} % {n} != 0"
+
+    # Fill bytes with k fields each, then read every 4 bytes as one int32.
+    tensor = tensor.to(torch.uint8)
+    mask = (1 << bit) - 1
+    packed = tensor[..., 0::k].bitwise_and(mask)
+    for j in range(1, k):
+        field = tensor[..., j::k].bitwise_and(mask).bitwise_left_shift_(j * bit)
+        packed.bitwise_or_(field)
+    if sys.byteorder == "big":
+        packed = packed.view(*packed.shape[:-1], -1, 4).flip(-1).flatten(-2)
+    packed = packed.flatten().view(torch.int32).view(*tensor.shape[:-1], -1)
+    return packed.movedim(-1, dim).contiguous()
+
+
+def unpack_tensor(packed, bit, dim=-1, signed=False, dtype=torch.int32):
+    assert bit in (1, 2, 4, 8), f"Can not unpack {bit}-bit integers from int32."
+    assert not (signed and dtype == torch.uint8), "uint8 can not hold signed values."
+    k = 8 // bit
+    packed = packed.movedim(dim, -1).contiguous()
+    shape = packed.shape
+
+    packed = packed.flatten().view(torch.uint8).view(*shape[:-1], -1)
+    if sys.byteorder == "big":
+        packed = packed.view(*shape[:-1], -1, 4).flip(-1).flatten(-2)
+    mask = (1 << bit) - 1
+    tensor = torch.stack(
+        [packed.bitwise_right_shift(j * bit).bitwise_and_(mask) for j in range(k)],
+        dim=-1,
+    )
+    tensor = tensor.reshape(*shape[:-1], -1)
+    if signed:
+        # Flipping the sign bit maps two's complement v to v + 2 ** (bit - 1).
+        half = 2 ** (bit - 1)
+        tensor = tensor.bitwise_xor_(half).to(dtype) - half
+    else:
+        tensor = tensor.to(dtype)
+    return tensor.movedim(-1, dim).contiguous()
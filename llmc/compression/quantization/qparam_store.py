@@ -0,0 +1,68 @@
+import torch
+from collections import defaultdict
+
+
+class QParamStore:
+    """
+    Holds the dense ``buf_*`` qparams of every block in one flat tensor per
+    dtype. ``index[(block_idx, layer_name)][buf_name]`` is ``(dtype, offset,
+    shape)``, and bound modules see views of the flat tensors instead of own
+    buffers. Sparse qparams (e.g. the SpQR outlier mask) stay with the modules.
+    """
+
+    def __init__(self, index=None, data=None):
+        self.index = index if index is not None else {}
+        self.data = data if data is not None else {}
+
+    def __len__(self):
+        return sum(len(bufs) for bufs in self.index.values())
+
+    @classmethod
+    @torch.no_grad()
+    def from_blocks(cls, blocks):
+        groups = defaultdict(list)
+        for idx, block in enumerate(blocks):
+            for name, module in block.named_modules():
+                for buf_name, buf in module.named_buffers(recurse=False):
+                    if buf_name.startswith("buf_") and buf.layout == torch.strided:
+                        groups[buf.dtype].append((idx, name, buf_name, buf))
+
+        store = cls()
+        for dtype, bufs in groups.items():
+            offset = 0
+            for idx, name, buf_name, buf in bufs:
+                store.index.setdefault((idx, name), {})[buf_name] = (
+                    dtype,
+                    offset,
+                    tuple(buf.shape),
+                )
+                offset += buf.numel()
+            store.data[dtype] = torch.cat([buf.reshape(-1).cpu() for *_, buf in bufs])
+        store.bind(blocks)
+        return store
+
+    def get(self, block_idx, layer_name):
+        qparams = {}
+        for buf_name, (dtype, offset, shape) in self.index[(block_idx, layer_name)].items():
+            numel = 1
+            for size in shape:
+                numel *= size
+            qparams[buf_name] = self.data[dtype][offset : offset + numel].view(shape)
+        return qparams
+
+    def bind(self, blocks):
+        # Bound buffers stay in the state_dict, the store is an extra copy.
+        for idx, name in self.index:
+            module = blocks[idx].get_submodule(name)
+            for buf_name, view in self.get(idx, name).items():
+                module.register_buffer(buf_name, view)
+        return self
+
+    def save(self, path):
+        data = {dtype: t.cpu() for dtype, t in self.data.items()}
+        torch.save({"index": self.index, "data": data}, path)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        state = torch.load(path, map_location=device)
+        return cls(state["index"], state["data"])
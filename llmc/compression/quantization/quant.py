@@ -3,6 +3,78 @@ from torch import nn
 from loguru import logger
 
 
+class FakeQuantFunction(torch.autograd.Function):
+    """
+    quant_dequant in a single buffer. The backward recomputes the clamp mask
+    from the saved inputs and reproduces the gradients of the unfused graph,
+    with ``ste`` passing the gradient through round.
+    """
+
+    @staticmethod
+    def quant(tensor, scales, zeros, max_int, min_int, round_zp):
+        if zeros is not None and not round_zp:
+            tensor = tensor / scales.clamp_min(1e-9)
+            tensor.add_(zeros).round_()
+        else:
+            tensor = torch.div(tensor, scales).round_()
+            if zeros is not None:
+                tensor.add_(zeros)
+        return tensor
+
+    @staticmethod
+    def forward(ctx, tensor, scales, zeros, max_int, min_int, round_zp, ste):
+        ctx.save_for_backward(tensor, scales, zeros)
+        ctx.max_int, ctx.min_int, ctx.round_zp, ctx.ste = max_int, min_int, round_zp, ste
+        q_tensor = FakeQuantFunction.quant(
+            tensor, scales, zeros, max_int, min_int, round_zp
+        )
+        q_tensor.clamp_(min_int, max_int)
+        if zeros is not None:
+            q_tensor.sub_(zeros)
+        return q_tensor.mul_(scales)
+
+    @staticmethod
+    def backward(ctx, grad):
+        tensor, scales, zeros = ctx.saved_tensors
+        max_int, min_int, round_zp, ste = ctx.max_int, ctx.min_int, ctx.round_zp, ctx.ste
+        clamp_scales = zeros is not None and not round_zp
+        div_scales = scales.clamp_min(1e-9) if clamp_scales else scales
+
+        q_tensor = FakeQuantFunction.quant(
+            tensor, scales, zeros, max_int, min_int, round_zp
+        )
+        mask = (q_tensor > min_int) & (q_tensor < max_int)
+        q_tensor.clamp_(min_int, max_int)
+        if zeros is not None:
+            q_tensor.sub_(zeros)
+        grad_q = grad * scales
+        grad_in = grad_q * mask if ste else None
+
+        grad_tensor = grad_scales = grad_zeros = None
+        if ctx.needs_input_grad[0]:
+            if ste:
+                grad_tensor = grad_in / div_scales
+            else:
+                grad_tensor = torch.zeros_like(tensor)
+        if ctx.needs_input_grad[1]:
+            grad_scales = grad * q_tensor
+            if ste:
+                grad_div = grad_in * tensor / div_scales.pow(2)
+                if clamp_scales:
+                    grad_div = grad_div * (scales >= 1e-9)
+                grad_scales = grad_scales - grad_div
+            grad_scales = grad_scales.sum_to_size(scales.shape)
+        if zeros is not None and ctx.needs_input_grad[2]:
+            if round_zp:
+                grad_zeros = grad_q * mask - grad_q
+            elif ste:
+                grad_zeros = grad_in - grad_q
+            else:
+                grad_zeros = -grad_q
+            grad_zeros = grad_zeros.sum_to_size(zeros.shape)
+        return grad_tensor, grad_scales, grad_zeros, None, None, None, None
+
+
 class Quantizer:
     def __init__(self, bit, symmetric, granularity, **kwargs):
         self.bit = bit
@@ -33,13 +105,14 @@ class Quantizer:
             self.round_func = torch.round
 
         self.round_zp = "round_zp" not in self.kwargs or self.kwargs["round_zp"]
+        self.fused = "fused" in self.kwargs and self.kwargs["fused"]
         self.sigmoid = torch.nn.Sigmoid()
 
     def get_tensor_range(self, tensor, args={}):
         if self.calib_algo == "minmax":
             return self.get_minmax_range(tensor)
         elif self.calib_algo == "mse":
-            return self.get_mse_range(tensor, **args)
+            return self.get_mse_range(tensor, **{**self.kwargs.get("mse", {}), **args})
         elif self.calib_algo == "learnable":
             return self.get_learnable_range(tensor, **args)
         else:
@@ -55,51 +128,74 @@ class Quantizer:
 
         return (min_val, max_val)
 
-    def get_mse_range(self, tensor, grid=100, norm=2.4, maxshrink=0.8, bs=1024):
-        assert tensor.shape[0] % bs == 0
+    def get_mse_range(
+        self, tensor, grid=100, norm=2.4, maxshrink=0.8, independent=False, mem_gb=None
+    ):
+        """
+        Pick, per row (per tensor for per_tensor), the shrunk range with the
+        lowest Lp quant error. Shrink candidates are evaluated together in
+        chunks of about ``mem_gb`` (default: cache sized on cpu, 1 GB on cuda).
+        ``independent`` searches min and max shrinks separately for asymmetric
+        quant.
+        """
+        shape = tensor.shape
+        if self.granularity == "per_tensor":
+            tensor = tensor.reshape(1, -1)
+        else:
+            tensor = tensor.reshape(-1, shape[-1])
         tensor = tensor.float()
         min_val, max_val = self.get_minmax_range(tensor)
+        if self.granularity == "per_tensor":
+            min_val, max_val = min_val.view(1, 1), max_val.view(1, 1)
 
-        dev = tensor.device
-
-        for b_num in range(tensor.shape[0] // bs):
-            _tensor = tensor[b_num * bs : (b_num + 1) * bs, :]
-            _min_val, _max_val = (
-                min_val[b_num * bs : (b_num + 1) * bs, :],
-                max_val[b_num * bs : (b_num + 1) * bs, :],
-            )
-
-            best = torch.full([_tensor.shape[0]], float("inf"), device=dev)
-
-            best_min_val, best_max_val = _min_val, _max_val
-
-            for i in range(int(maxshrink * grid)):
-                p = 1 - i / grid
-
-                xmin = p * _min_val
-                xmax = p * _max_val
-
-                scales, zeros, max_int, min_int = self.get_qparams((xmin, xmax), dev)
-                q_tensor = self.quant_dequant(_tensor, scales, zeros, max_int, min_int)
-
-                q_tensor -= _tensor
-                q_tensor.abs_()
-                q_tensor.pow_(norm)
-                err = torch.sum(q_tensor, 1)
-
-                tmp = err < best
-
-                if torch.any(tmp):
-                    best[tmp] = err[tmp]
-                    best_min_val[tmp] = xmin[tmp]
-                    best_max_val[tmp] = xmax[tmp]
-
-            (
-                min_val[b_num * bs : (b_num + 1) * bs, :],
-                max_val[b_num * bs : (b_num + 1) * bs, :],
-            ) = (best_min_val, best_max_val)
+        shrinks = torch.tensor(
+            [1 - i / grid for i in range(int(maxshrink * grid))], device=tensor.device
+        )
+        if independent and not self.sym:
+            lo, hi = torch.meshgrid(shrinks, shrinks, indexing="ij")
+            lo, hi = lo.flatten(), hi.flatten()
+        else:
+            lo, hi = shrinks, shrinks
+
+        if mem_gb is None:
+            mem_gb = 1 if tensor.is_cuda else 1 / 256
+        budget = max(1, int(mem_gb * 1024**3) // (4 * tensor.shape[1]))
+        cand_bs = min(len(lo), budget)
+        row_bs = max(1, budget // cand_bs)
+
+        best_lo, best_hi = torch.ones_like(min_val), torch.ones_like(max_val)
+        with torch.no_grad():
+            for r in range(0, tensor.shape[0], row_bs):
+                _tensor = tensor[r : r + row_bs]
+                _min_val, _max_val = min_val[r : r + row_bs], max_val[r : r + row_bs]
+                best = torch.full_like(_min_val, float("inf"))
+
+                for c in range(0, len(lo), cand_bs):
+                    xmin = lo[c : c + cand_bs].view(-1, 1, 1) * _min_val
+                    xmax = hi[c : c + cand_bs].view(-1, 1, 1) * _max_val
+                    err, idx = self.get_lp_error(_tensor, (xmin, xmax), norm).min(0)
+
+                    tmp = err < best
+                    best = torch.where(tmp, err, best)
+                    best_lo[r : r + row_bs][tmp] = lo[c + idx[tmp]]
+                    best_hi[r : r + row_bs][tmp] = hi[c + idx[tmp]]
+
+        min_val, max_val = best_lo * min_val, best_hi * max_val
+        if self.granularity == "per_tensor":
+            return (min_val.reshape(()), max_val.reshape(()))
+        return (min_val.reshape(*shape[:-1], 1), max_val.reshape(*shape[:-1], 1))
 
-        return (min_val, max_val)
+    def get_lp_error(self, tensor, tensor_range, norm):
+        # quant_dequant in place, for ranges that broadcast over candidates.
+        scales, zeros, max_int, min_int = self.get_qparams(tensor_range, tensor.device)
+        q_tensor = FakeQuantFunction.quant(
+            tensor, scales, zeros, max_int, min_int, self.round_zp
+        )
+        q_tensor.clamp_(min_int, max_int)
+        if zeros is not None:
+            q_tensor.sub_(zeros)
+        q_tensor.mul_(scales).sub_(tensor).abs_().pow_(norm)
+        return q_tensor.sum(dim=-1, keepdim=True)
 
     def get_learnable_range(self, tensor, lowbound_factor=None, upbound_factor=None):
         min_val, max_val = self.get_minmax_range(tensor)
@@ -154,6 +250,11 @@ class Quantizer:
         return tensor
 
     def quant_dequant(self, tensor, scales, zeros, max_int, min_int):
+        if self.fused:
+            ste = "ste" in self.kwargs and self.kwargs["ste"]
+            return FakeQuantFunction.apply(
+                tensor, scales, zeros, max_int, min_int, self.round_zp, ste
+            )
         tensor = self.quant(tensor, scales, zeros, max_int, min_int)
         tensor = self.dequant(tensor, scales, zeros)
         return tensor
@@ -4,6 +4,8 @@ import torch.nn as nn
 import gc
 from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
+from llmc.utils.device import get_device, empty_cache
+from llmc.utils.tracer import tracer
 from tqdm import tqdm
 
 
@@ -70,18 +72,20 @@ class QUIK(BaseBlockwiseQuantization):
         with torch.no_grad():
             for i in tqdm(range(len(self.blocks))):
                 block = self.blocks[i]
-                block.cuda()
+                block.to(get_device())
+                tracer.add_module_bytes(block)
                 if i == 0:
                     fp_inps = self.block_forward(block)
                 else:
                     fp_inps = self.block_forward(block, fp_inps)
 
+                tracer.add_module_bytes(block)
                 block.cpu()
 
         for h in hooks:
             h.remove()
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
 
         return act_stat
 
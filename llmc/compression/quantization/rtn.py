@@ -6,6 +6,8 @@ import torch
 
 @ALGO_REGISTRY
 class RTN(BaseBlockwiseQuantization):
+    parallel_layers = True
+
     def __init__(self, model, quant_config, input=None, config=None):
         super().__init__(model, quant_config, input, config)
         if quant_config.get("act", False) and quant_config["act"].get("static", False):
@@ -5,6 +5,7 @@ from transformers.models.llama.modeling_llama import LlamaRMSNorm
 from transformers.models.mistral.modeling_mistral import MistralRMSNorm
 from .base_blockwise_quantization import BaseBlockwiseQuantization
 from llmc.utils.registry_factory import ALGO_REGISTRY
+from llmc.utils.device import get_device, empty_cache
 
 
 @ALGO_REGISTRY
@@ -29,14 +30,14 @@ class SmoothQuant(BaseBlockwiseQuantization):
         scale = scale.max(dim=0)[0].clamp(min=1e-5)
         del weights
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
         return scale
 
     @torch.no_grad()
     def get_act_scale(self, tensors):
         scale_max = None
         for x in tensors:
-            x = x.cuda()
+            x = x.to(get_device())
             x = x.abs().view(-1, x.shape[-1])
             comming_max = torch.max(x, dim=0)[0].float()
             if scale_max is not None:
@@ -11,6 +11,7 @@ import math
 import copy
 from .module_utils import FakeQuantLinear
 from .quant import Quantizer
+from llmc.utils.device import get_device, empty_cache, synchronize
 
 
 @ALGO_REGISTRY
@@ -20,7 +21,7 @@ class SpQR(BaseBlockwiseQuantization):
         assert (
             self.wquantizer.granularity == "per_group"
         ), "SpQR only supports per_group quantization"
-        self.dev = torch.device("cuda")
+        self.dev = get_device()
         self.model_dtype = next(self.model.model.parameters()).dtype
         self.add_quant_config()
         self.layers_cache = {}
@@ -69,7 +70,7 @@ class SpQR(BaseBlockwiseQuantization):
                 self.block_forward(block)
                 for h in handles:
                     h.remove()
-                torch.cuda.empty_cache()
+                empty_cache()
 
                 self.subset_transform(subset["layers"])
                 params_dict = {}
@@ -114,36 +115,26 @@ class SpQR(BaseBlockwiseQuantization):
         self.groups = [None] * (self.columns // self.wquantizer.group_size)
 
         H = self.layers_cache[name]["H"]
-        del self.layers_cache[name]["H"]
+        dead = torch.diag(H) == 0
 
         if self.actorder:
             self.perm = torch.argsort(torch.diag(H), descending=True)
             W = W[:, self.perm]
-            H = H[self.perm][:, self.perm]
+            dead = dead[self.perm]
             self.invperm = torch.argsort(self.perm)
             layer.register_buffer("buf_perm", self.perm)
             layer.register_buffer("buf_invperm", self.invperm)
 
-        dead = torch.diag(H) == 0
-        if self.percdamp > 0:
-            damp = self.percdamp * abs(torch.diag(H)).mean()
-            diag = torch.arange(self.columns, device=self.dev)
-            H[diag, diag] += damp
-            del diag
-        H[dead, dead] = 1
         W[:, dead] = 0
 
         Losses = torch.zeros_like(W)
         tmp = torch.zeros_like(W)
 
-        H = torch.linalg.cholesky(H)
-        H = torch.cholesky_inverse(H)
-        H = torch.linalg.cholesky(H, upper=True)
-        Hinv = H
+        Hinv = self.get_hinv(name)
         mask = torch.zeros_like(W, dtype=torch.bool)
         self.weight_transform(W, Hinv, Losses, tmp, mask)
 
-        torch.cuda.synchronize()
+        synchronize()
         logger.info(f"time {time.time() - tick}")
         logger.info(f"error {torch.sum(Losses).item()}")
 
@@ -165,6 +156,32 @@ class SpQR(BaseBlockwiseQuantization):
             self.set_model_qparams(layer)
             layer.register_buffer("buf_mask", mask.float().to_sparse())
 
+    @torch.no_grad()
+    def get_hinv(self, name):
+        cache = self.layers_cache[name]
+        if "Hinv" in cache:
+            return cache["Hinv"]
+
+        H = cache["H"]
+        if self.actorder:
+            H = H[self.perm][:, self.perm]
+        else:
+            H = H.clone()
+
+        dead = torch.diag(H) == 0
+        if self.percdamp > 0:
+            damp = self.percdamp * abs(torch.diag(H)).mean()
+            diag = torch.arange(self.columns, device=self.dev)
+            H[diag, diag] += damp
+            del diag
+        H[dead, dead] = 1
+
+        H = torch.linalg.cholesky(H)
+        H = torch.cholesky_inverse(H)
+        H = torch.linalg.cholesky(H, upper=True)
+        cache["Hinv"] = H
+        return H
+
     @torch.no_grad()
     def weight_transform(self, W, Hinv, Losses, tmp, mask):
         def outliers(G, HinvGD):
@@ -239,7 +256,8 @@ class SpQR(BaseBlockwiseQuantization):
 
     @torch.no_grad()
     def cache_input_hook(self, m, inp, out, name, feat_dict):
-        self.add_batch(self.named_layers[name], name, inp[0].data, out.data)
+        if self.layers_cache[name]["owner"] == name:
+            self.add_batch(self.named_layers[name], name, inp[0].data, out.data)
 
     @torch.no_grad()
     def add_batch(self, layer, name, inp, out):
@@ -280,20 +298,37 @@ class SpQR(BaseBlockwiseQuantization):
         )
         self.layers_cache[name]["nsamples"] = 0
         self.layers_cache[name]["columns"] = W.shape[1]
+        self.layers_cache[name]["owner"] = name
+
+    @torch.no_grad()
+    def subsets_init(self, subsets):
+        # Layers of a subset consume the same input, so they share one cache
+        # (H, nsamples and Hinv) that only the input layer accumulates.
+        shared = set()
+        for subset in subsets:
+            owner = subset["input"][0]
+            if owner not in subset["layers"]:
+                owner = next(iter(subset["layers"]))
+            self.layers_cache[owner] = {}
+            self.layer_init(subset["layers"][owner], owner)
+            for name in subset["layers"]:
+                self.layers_cache[name] = self.layers_cache[owner]
+                shared.add(name)
+
+        for name in self.named_layers:
+            if name not in shared:
+                self.layers_cache[name] = {}
+                self.layer_init(self.named_layers[name], name)
 
     @torch.no_grad()
     def subset_init(self, subset):
         self.named_layers = subset["layers"]
-        for name in self.named_layers:
-            self.layers_cache[name] = {}
-            self.layer_init(self.named_layers[name], name)
+        self.subsets_init([subset])
 
     @torch.no_grad()
     def block_init(self, block):
         self.named_layers = self.model.get_block_linears(block)
-        for name in self.named_layers:
-            self.layers_cache[name] = {}
-            self.layer_init(self.named_layers[name], name)
+        self.subsets_init(self.model.get_subsets_in_block(block))
 
     @torch.no_grad()
     def merge_qparams(self, qparams):
@@ -337,13 +372,14 @@ class SpQR(BaseBlockwiseQuantization):
         d["zeros"] = self.merge_qparams([g["zeros"] for g in self.groups])
         for k, v in d.items():
             layer.register_buffer("buf_" + k, copy.deepcopy(v))
-        layer.register_buffer("buf_max_int", self.groups[0]["max_int"])
-        layer.register_buffer("buf_min_int", self.groups[0]["min_int"])
+        max_int, min_int = self.groups[0]["max_int"], self.groups[0]["min_int"]
+        layer.register_buffer("buf_max_int", torch.tensor(max_int))
+        layer.register_buffer("buf_min_int", torch.tensor(min_int))
 
     @torch.no_grad()
     def free(self, name):
         del self.layers_cache[name]
-        torch.cuda.empty_cache()
+        empty_cache()
 
     @torch.no_grad()
     def w_q(self, weight, qargs):
@@ -5,7 +5,9 @@ import sys
 import os
 import time
 from math import inf
+from collections import defaultdict
 from loguru import logger
+from llmc.utils.device import get_autocast_dtype
 
 
 class TruncateFunction(torch.autograd.Function):
@@ -54,8 +56,15 @@ class LossFunction:
 
 
 class NativeScalerWithGradNormCount:
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    """
+    One training step: backward, gradient norm and optimizer step. Loss scaling
+    is only used with float16 autocast, bfloat16 (the cpu autocast dtype) keeps
+    the float32 exponent range and steps without a scaler.
+    """
+
+    def __init__(self, enabled=True):
+        enabled = enabled and get_autocast_dtype() == torch.float16
+        self._scaler = torch.cuda.amp.GradScaler() if enabled else None
 
     def __call__(
         self,
@@ -67,41 +76,44 @@ class NativeScalerWithGradNormCount:
         update_grad=True,
         retain_graph=False,
     ):
-        self._scaler.scale(loss).backward(
-            create_graph=create_graph, retain_graph=retain_graph
-        )
-        if update_grad:
-            if clip_grad is not None:
-                assert parameters is not None
-                self._scaler.unscale_(optimizer)
-                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
-            else:
-                self._scaler.unscale_(optimizer)
-                norm = self.ampscaler_get_grad_norm(parameters)
+        if self._scaler is not None:
+            loss = self._scaler.scale(loss)
+        loss.backward(create_graph=create_graph, retain_graph=retain_graph)
+        if not update_grad:
+            return None
+        if self._scaler is not None:
+            self._scaler.unscale_(optimizer)
+        if clip_grad is not None:
+            assert parameters is not None
+            norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad, foreach=True)
+        else:
+            norm = self.ampscaler_get_grad_norm(parameters)
+        if self._scaler is not None:
             self._scaler.step(optimizer)
             self._scaler.update()
         else:
-            norm = None
+            optimizer.step()
         return norm
 
     def ampscaler_get_grad_norm(self, parameters, norm_type=2.0):
         if isinstance(parameters, torch.Tensor):
             parameters = [parameters]
-        parameters = [p for p in parameters if p.grad is not None]
+        grads = [p.grad.detach() for p in parameters if p.grad is not None]
         norm_type = float(norm_type)
-        if len(parameters) == 0:
+        if len(grads) == 0:
             return torch.tensor(0.0)
-        device = parameters[0].grad.device
+        device = grads[0].device
+        # Norms of the grads sharing a device and dtype in one foreach kernel.
+        groups = defaultdict(list)
+        for g in grads:
+            groups[(g.device, g.dtype)].append(g)
+        norms = []
+        for group in groups.values():
+            if norm_type == inf:
+                norms.extend(g.abs().max() for g in group)
+            else:
+                norms.extend(torch._foreach_norm(group, norm_type))
+        norms = torch.stack([n.to(device, torch.float32) for n in norms])
         if norm_type == inf:
-            total_norm = max(p.grad.detach().abs().max().to(device) for p in parameters)
-        else:
-            total_norm = torch.norm(
-                torch.stack(
-                    [
-                        torch.norm(p.grad.detach(), norm_type).to(device)
-                        for p in parameters
-                    ]
-                ),
-                norm_type,
-            )
-        return total_norm
\ No newline at end of file
+            return norms.max()
+        return torch.norm(norms, norm_type)
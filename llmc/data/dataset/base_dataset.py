@@ -1,8 +1,14 @@
+import os
+import random
+import tempfile
+import inspect
 from abc import ABCMeta
 from datasets import load_dataset, load_from_disk
 import torch
 from loguru import logger
+from llmc.utils.utils import cache_key
 from .specified_preproc import PREPROC_REGISTRY
+from ..tokenizer import ParallelEncoder
 
 
 class BaseDataset(metaclass=ABCMeta):
@@ -19,6 +25,8 @@ class BaseDataset(metaclass=ABCMeta):
         self.seq_len = calib_cfg["seq_len"]
         self.preproc = calib_cfg["preproc"]
         self.seed = calib_cfg["seed"]
+        self.cache_path = calib_cfg.get("cache_path", None)
+        self.num_workers = calib_cfg.get("num_workers", 0)
         self.dataset_key = {
             "pileval": "text",
             "c4": "text",
@@ -27,7 +35,30 @@ class BaseDataset(metaclass=ABCMeta):
         }
         if self.calib_dataset_name in self.dataset_key:
             self.key = self.dataset_key[self.calib_dataset_name]
-        self.build_calib_dataset()
+        self.calib_dataset = None
+        # Hashing the tokenizer sorts its whole vocab, so the key is made once.
+        self.cache_file_name = self.cache_file()
+        if self.cache_file_name is None or not os.path.exists(self.cache_file_name):
+            self.build_calib_dataset()
+
+    def cache_file(self):
+        if self.cache_path is None:
+            return None
+        if self.download:
+            source = self.calib_dataset_name
+        else:
+            path = self.calib_dataset_path
+            source = (os.path.abspath(path), os.path.getmtime(path))
+        key = cache_key(
+            self.tokenizer,
+            self.calib_dataset_name,
+            source,
+            self.preproc,
+            self.n_samples,
+            self.seq_len,
+            self.seed,
+        )
+        return os.path.join(self.cache_path, f"{self.calib_dataset_name}_{key}.pth")
 
     def build_calib_dataset(self):
         if self.download:
@@ -69,14 +100,48 @@ class BaseDataset(metaclass=ABCMeta):
                     self.calib_dataset.append(line.strip())
 
     def get_calib_samples(self):
+        file_name = self.cache_file_name
+        if file_name is not None and os.path.exists(file_name):
+            cache = torch.load(file_name)
+            # Leave the random state as running the preproc would have.
+            random.setstate(cache["random_state"])
+            logger.info(f"Load calib samples from {file_name}")
+            return [
+                s.view(1, -1).long()
+                for s in cache["input_ids"].split(cache["lengths"])
+            ]
+
+        if self.calib_dataset is None:
+            self.build_calib_dataset()
+        samples = self.preproc_samples()
+
+        if file_name is not None and isinstance(samples, list):
+            os.makedirs(self.cache_path, exist_ok=True)
+            cache = {
+                "input_ids": torch.cat([s.view(-1) for s in samples]).int(),
+                "lengths": [s.numel() for s in samples],
+                "random_state": random.getstate(),
+            }
+            # A temp file of its own, so concurrent jobs never write the same one.
+            fd, tmp_name = tempfile.mkstemp(dir=self.cache_path, suffix=".tmp")
+            os.close(fd)
+            torch.save(cache, tmp_name)
+            os.replace(tmp_name, file_name)
+            logger.info(f"Save calib samples to {file_name}")
+        return samples
+
+    def preproc_samples(self):
         if self.preproc == "general":
             samples = self.general_preproc(
                 self.calib_dataset, self.tokenizer, self.n_samples, self.seq_len
             )
         else:
             preproc = PREPROC_REGISTRY[self.preproc]
+            kwargs = {}
+            if "num_workers" in inspect.signature(preproc).parameters:
+                kwargs["num_workers"] = self.num_workers
             samples = preproc(
-                self.calib_dataset, self.tokenizer, self.n_samples, self.seq_len
+                self.calib_dataset, self.tokenizer, self.n_samples, self.seq_len, **kwargs
             )
         return samples
 
@@ -102,16 +167,13 @@ class BaseDataset(metaclass=ABCMeta):
         dataset = calib_dataset.shuffle(seed=self.seed)
         samples = []
         n_run = 0
-        for data in dataset:
-            line = data[self.key]
-            trainenc = tokenizer(
-                line, return_tensors="pt", max_length=seq_len, truncation=True
-            )
-            line_encoded = trainenc.input_ids
-            if line_encoded.shape[1] < seq_len:
-                continue
-            samples.append(line_encoded)
-            n_run += 1
-            if n_run == n_samples:
-                break
+        with ParallelEncoder(tokenizer, self.num_workers) as encoder:
+            lines = (data[self.key] for data in dataset)
+            for line_encoded in encoder.iter(lines, max_length=seq_len, truncation=True):
+                if len(line_encoded) < seq_len:
+                    continue
+                samples.append(torch.tensor([line_encoded]))
+                n_run += 1
+                if n_run == n_samples:
+                    break
         return samples
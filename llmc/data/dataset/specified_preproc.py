@@ -1,6 +1,7 @@
 import random
 import torch
 from llmc.utils.registry_factory import PREPROC_REGISTRY
+from ..tokenizer import ParallelEncoder
 
 
 @PREPROC_REGISTRY
@@ -28,39 +29,53 @@ def ptb_gptq(calib_dataset, tokenizer, n_samples, seq_len):
 
 
 @PREPROC_REGISTRY
-def c4_gptq(calib_dataset, tokenizer, n_samples, seq_len):
+def c4_gptq(calib_dataset, tokenizer, n_samples, seq_len, num_workers=0):
     samples = []
-    for _ in range(n_samples):
-        while True:
-            i = random.randint(0, len(calib_dataset) - 1)
-            trainenc = tokenizer(calib_dataset[i]["text"], return_tensors="pt")
-            if trainenc.input_ids.shape[1] >= seq_len:
-                break
-        i = random.randint(0, trainenc.input_ids.shape[1] - seq_len - 1)
-        j = i + seq_len
-        inp = trainenc.input_ids[:, i:j]
-        samples.append(inp)
+    with ParallelEncoder(tokenizer, num_workers) as encoder:
+        # Documents the next draws pick if the current one is rejected, they
+        # are tokenized together when the encoder can batch them.
+        lookahead = 32 if encoder.parallel else 1
+        encoded = {}
+        for _ in range(n_samples):
+            while True:
+                i = random.randint(0, len(calib_dataset) - 1)
+                if i not in encoded:
+                    rng = random.Random()
+                    rng.setstate(random.getstate())
+                    ids = [i] + [
+                        rng.randint(0, len(calib_dataset) - 1)
+                        for _ in range(lookahead - 1)
+                    ]
+                    texts = [calib_dataset[j]["text"] for j in ids]
+                    encoded = dict(zip(ids, encoder(texts)))
+                if len(encoded[i]) >= seq_len:
+                    break
+            trainenc = torch.tensor([encoded[i]])
+            i = random.randint(0, trainenc.shape[1] - seq_len - 1)
+            j = i + seq_len
+            inp = trainenc[:, i:j]
+            samples.append(inp)
+            encoded = {}
     return samples
 
 
 @PREPROC_REGISTRY
-def pileval_awq(calib_dataset, tokenizer, n_samples, seq_len):
+def pileval_awq(calib_dataset, tokenizer, n_samples, seq_len, num_workers=0):
     dataset = calib_dataset.shuffle(seed=42)
     samples = []
     n_run = 0
-    for data in dataset:
-        line = data["text"]
-        line = line.strip()
-        line_encoded = tokenizer.encode(line)
-        if len(line_encoded) > seq_len:
-            continue
-        sample = torch.tensor([line_encoded])
-        if sample.numel() == 0:
-            continue
-        samples.append(sample)
-        n_run += 1
-        if n_run == n_samples:
-            break
+    with ParallelEncoder(tokenizer, num_workers) as encoder:
+        lines = (data["text"].strip() for data in dataset)
+        for line_encoded in encoder.iter(lines):
+            if len(line_encoded) > seq_len:
+                continue
+            sample = torch.tensor([line_encoded])
+            if sample.numel() == 0:
+                continue
+            samples.append(sample)
+            n_run += 1
+            if n_run == n_samples:
+                break
     samples = torch.cat(samples, dim=1)
     n_split = samples.shape[1] // seq_len
     samples = [samples[:, i * seq_len : (i + 1) * seq_len] for i in range(n_split)]
@@ -68,20 +83,17 @@ def pileval_awq(calib_dataset, tokenizer, n_samples, seq_len):
 
 
 @PREPROC_REGISTRY
-def pileval_smooth(calib_dataset, tokenizer, n_samples, seq_len):
+def pileval_smooth(calib_dataset, tokenizer, n_samples, seq_len, num_workers=0):
     dataset = calib_dataset.shuffle(seed=42)
     samples = []
     n_run = 0
-    for data in dataset:
-        line = data["text"]
-        trainenc = tokenizer(
-            line, return_tensors="pt", max_length=seq_len, truncation=True
-        )
-        line_encoded = trainenc.input_ids
-        samples.append(line_encoded)
-        n_run += 1
-        if n_run == n_samples:
-            break
+    with ParallelEncoder(tokenizer, num_workers) as encoder:
+        lines = (data["text"] for data in dataset)
+        for line_encoded in encoder.iter(lines, max_length=seq_len, truncation=True):
+            samples.append(torch.tensor([line_encoded]))
+            n_run += 1
+            if n_run == n_samples:
+                break
     return samples
 
 
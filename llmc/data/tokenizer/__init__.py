@@ -1 +1,2 @@
 from .base_tokenizer import BaseTokenizer
+from .parallel_encoder import ParallelEncoder
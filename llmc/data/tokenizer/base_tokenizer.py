@@ -1,19 +1,46 @@
 from abc import ABCMeta
+from loguru import logger
 from transformers import AutoTokenizer
 
 
 class BaseTokenizer(metaclass=ABCMeta):
-    def __init__(self, tokenizer_path):
+    # Texts the fast tokenizer has to encode exactly like the slow one in auto mode.
+    probe_texts = [
+        "Hello world! This is a test.",
+        "  leading and trailing spaces  ",
+        "\n\nNew lines\n\n and\ttabs\t.",
+        "Numbers 1234567890 and 3.14159, symbols @#$%^&*()_+-=[]{}|;':\",./<>?",
+        "Unicode: café naïve 東京 Привет мир 🙂",
+        " = Valkyria Chronicles III = \n Senjō no Valkyria 3 : <unk> Chronicles",
+    ]
+
+    def __init__(self, tokenizer_path, tokenizer_mode="slow"):
         self.tokenizer_path = tokenizer_path
+        self.tokenizer_mode = tokenizer_mode
         self.build_tokenizer()
 
     def __str__(self):
         return str(self.tokenizer)
 
     def build_tokenizer(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.tokenizer_path, use_fast=False, trust_remote_code=True
-        )
+        if self.tokenizer_mode in ["slow", "auto"]:
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                self.tokenizer_path, use_fast=False, trust_remote_code=True
+            )
+        if self.tokenizer_mode in ["fast", "auto"]:
+            fast_tokenizer = AutoTokenizer.from_pretrained(
+                self.tokenizer_path, use_fast=True, trust_remote_code=True
+            )
+            if self.tokenizer_mode == "fast" or self.equivalent(fast_tokenizer):
+                self.tokenizer = fast_tokenizer
+        logger.info(f"use fast tokenizer : {self.tokenizer.is_fast}")
+
+    def equivalent(self, fast_tokenizer):
+        if not fast_tokenizer.is_fast:
+            return False
+        slow_ids = self.tokenizer(self.probe_texts).input_ids
+        fast_ids = fast_tokenizer(self.probe_texts).input_ids
+        return slow_ids == fast_ids
 
     def get_tokenizer(self):
         return self.tokenizer
@@ -0,0 +1,74 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode(texts, kwargs):
+    return _worker_tokenizer(texts, **kwargs).input_ids
+
+
+class ParallelEncoder:
+    """
+    Tokenizes texts in batches and hands back their input_ids in input order.
+    Fast tokenizers encode a batch in one call, slow ones split it over a
+    pool of ``num_workers`` processes (in-process if ``num_workers`` is 0).
+    """
+
+    def __init__(self, tokenizer, num_workers=0, batch_size=64):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.num_workers = 0 if tokenizer.is_fast else num_workers
+        self.executor = None
+        if self.num_workers > 0:
+            self.executor = ProcessPoolExecutor(
+                self.num_workers, initializer=_init_worker, initargs=(tokenizer,)
+            )
+
+    @property
+    def parallel(self):
+        return self.tokenizer.is_fast or self.executor is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __call__(self, texts, **kwargs):
+        texts = list(texts)
+        if self.executor is None:
+            return self.tokenizer(texts, **kwargs).input_ids if texts else []
+        size = -(-len(texts) // self.num_workers)
+        futures = [
+            self.executor.submit(_encode, texts[i : i + size], kwargs)
+            for i in range(0, len(texts), size)
+        ]
+        return [ids for future in futures for ids in future.result()]
+
+    def iter(self, texts, **kwargs):
+        # Lazily encodes an iterable, keeping a few batches per worker in flight.
+        texts = iter(texts)
+        batches = iter(lambda: list(islice(texts, self.batch_size)), [])
+        if self.executor is None:
+            for batch in batches:
+                yield from self.tokenizer(batch, **kwargs).input_ids
+            return
+        pending = deque()
+        for batch in batches:
+            pending.append(self.executor.submit(_encode, batch, kwargs))
+            if len(pending) >= 2 * self.num_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
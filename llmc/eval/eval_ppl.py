@@ -1,9 +1,15 @@
+import os
+import tempfile
 import torch
 import torch.nn as nn
 from loguru import logger
 import gc
 from datasets import load_dataset, load_from_disk
+from transformers import BatchEncoding
 from concurrent.futures import ThreadPoolExecutor
+from llmc.utils.device import get_device, empty_cache
+from llmc.utils.utils import cache_key
+from llmc.utils.tracer import tracer
 
 
 class PerplexityEval:
@@ -22,7 +28,52 @@ class PerplexityEval:
         self.path = eval_cfg.get("path", None)
         self.download = eval_cfg["download"]
         self.inference_per_block = eval_cfg.get("inference_per_block", False)
-        self.testenc = self.build_data()
+        self.cache_path = eval_cfg.get("cache_path", None)
+        self._testenc = None
+
+    @property
+    def testenc(self):
+        if self._testenc is None:
+            self._testenc = self.load_data()
+        return self._testenc
+
+    def cache_file(self):
+        if self.download:
+            source = self.dataset
+        else:
+            source = (os.path.abspath(self.path), os.path.getmtime(self.path))
+        key = cache_key(
+            self.tokenizer,
+            self.dataset,
+            source,
+            self.seq_len if self.dataset == "c4" else None,
+        )
+        return os.path.join(self.cache_path, f"{self.dataset}_{key}.bin")
+
+    @torch.no_grad()
+    def load_data(self):
+        if self.cache_path is None:
+            return self.build_data()
+
+        file_name = self.cache_file()
+        if not os.path.exists(file_name):
+            input_ids = self.build_data().input_ids
+            os.makedirs(self.cache_path, exist_ok=True)
+            # A temp file of its own, so concurrent jobs never write the same one.
+            fd, tmp_name = tempfile.mkstemp(dir=self.cache_path, suffix=".tmp")
+            os.close(fd)
+            mapped = torch.from_file(
+                tmp_name, shared=True, size=input_ids.numel(), dtype=torch.int64
+            )
+            mapped.copy_(input_ids.view(-1))
+            del mapped
+            os.replace(tmp_name, file_name)
+            logger.info(f"Save {self.dataset} tokens to {file_name}")
+
+        size = os.path.getsize(file_name) // 8
+        input_ids = torch.from_file(file_name, size=size, dtype=torch.int64)
+        logger.info(f"Load {self.dataset} tokens from {file_name}")
+        return BatchEncoding({"input_ids": input_ids.view(1, -1)})
 
     @torch.no_grad()
     def build_data(self):
@@ -60,31 +111,37 @@ class PerplexityEval:
 
     @torch.no_grad()
     def eval(self, model_llmc):
-        model = model_llmc.get_model()
-        if self.inference_per_block:
-            handles = []
-            for layer in model_llmc.get_blocks():
-                handles.append(layer.register_forward_pre_hook(self.forward_pre_hook))
-            for layer in model_llmc.get_blocks():
-                handles.append(layer.register_forward_hook(self.forward_hook))
-            for layer in model_llmc.get_layers_except_blocks():
-                layer.cuda()
-        else:
-            model.cuda()
-
-        model.eval()
-        ppl = self.eval_ppl_func(model, self.testenc, self.seq_len, self.bs)
-        if self.inference_per_block:
-            for h in handles:
-                h.remove()
-        model.cpu()
-        gc.collect()
-        torch.cuda.empty_cache()
-        return ppl
+        with tracer.span("eval", dataset=self.dataset):
+            model = model_llmc.get_model()
+            if self.inference_per_block:
+                handles = []
+                for layer in model_llmc.get_blocks():
+                    handles.append(
+                        layer.register_forward_pre_hook(self.forward_pre_hook)
+                    )
+                for layer in model_llmc.get_blocks():
+                    handles.append(layer.register_forward_hook(self.forward_hook))
+                for layer in model_llmc.get_layers_except_blocks():
+                    layer.to(get_device())
+                    tracer.add_module_bytes(layer)
+            else:
+                model.to(get_device())
+                tracer.add_module_bytes(model)
+
+            model.eval()
+            ppl = self.eval_ppl_func(model, self.testenc, self.seq_len, self.bs)
+            if self.inference_per_block:
+                for h in handles:
+                    h.remove()
+            model.cpu()
+            gc.collect()
+            empty_cache()
+            return ppl
 
     @torch.no_grad()
     def forward_pre_hook(self, m, x):
-        m.cuda()
+        m.to(get_device())
+        tracer.add_module_bytes(m)
 
     @torch.no_grad()
     def forward_hook(self, m, x, y):
@@ -93,6 +150,7 @@ class PerplexityEval:
 
     @torch.no_grad()
     def load_layer_to_cpu(self, m):
+        tracer.add_module_bytes(m)
         m.cpu()
 
     @torch.no_grad()
@@ -109,7 +167,7 @@ class PerplexityEval:
             j = min(i + bs, nsamples)
 
             # Prepare inputs and move to gpu
-            inputs = testenc[:, (i * seq_len) : (j * seq_len)].cuda()
+            inputs = testenc[:, (i * seq_len) : (j * seq_len)].to(get_device())
             inputs = inputs.reshape(j - i, seq_len)
 
             # Forward pass through the model
@@ -137,7 +195,7 @@ class PerplexityEval:
 
         # Empty CUDA cache to save memory
         testenc.cpu()
-        torch.cuda.empty_cache()
+        empty_cache()
 
         return ppl.item()
 
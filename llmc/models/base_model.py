@@ -16,6 +16,7 @@ from llmc.compression.quantization.module_utils import (
 )
 from transformers.models.llama.modeling_llama import LlamaRMSNorm
 from transformers.models.mistral.modeling_mistral import MistralRMSNorm
+from llmc.utils.device import get_device, empty_cache
 
 
 class BaseModel(metaclass=ABCMeta):
@@ -79,8 +80,10 @@ class BaseModel(metaclass=ABCMeta):
         )
 
     @torch.no_grad()
-    def collect_first_block_input(self, calib_data):
+    def collect_first_block_input(self, calib_data, act_store=None):
         first_block_input = defaultdict(list)
+        if act_store is not None:
+            first_block_input["data"] = act_store.tensor_list()
 
         class Catcher(nn.Module):
             def __init__(self, module):
@@ -92,8 +95,8 @@ class BaseModel(metaclass=ABCMeta):
                 first_block_input["kwargs"].append(kwargs)
                 raise ValueError
 
-        self.move_embed_to_device("cuda")
-        self.blocks[0] = self.blocks[0].cuda()
+        self.move_embed_to_device(get_device())
+        self.blocks[0] = self.blocks[0].to(get_device())
         self.blocks[0] = Catcher(self.blocks[0])
 
         for data in calib_data:
@@ -136,12 +139,12 @@ class BaseModel(metaclass=ABCMeta):
         for i in range(len(self.blocks)):
             logger.info(f"Replace block index: {i+1}/{len(self.blocks)}")
             block = self.blocks[i]
-            block = block.cuda()
+            block = block.to(get_device())
             self.replace_module_block(module, block, i, params_dict)
             block = block.cpu()
 
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache()
         logger.info(f"The Replaced model: {self.model}")
 
     def replace_module_block(self, module, block, i, params_dict):
@@ -1 +1,3 @@
-from .utils import seed_all, check_config, mkdirs
+from .utils import seed_all, check_config, mkdirs, cache_key
+from .device import init_device, get_device, empty_cache, synchronize, autocast
+from .tracer import tracer, traced
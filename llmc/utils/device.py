@@ -0,0 +1,72 @@
+import torch
+from contextlib import nullcontext
+from loguru import logger
+
+
+_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+_autocast_dtype = torch.float16 if _device.type == "cuda" else None
+
+
+def cpu_bf16_supported():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def init_device(base_config):
+    global _device, _autocast_dtype
+
+    default_device = "cuda" if torch.cuda.is_available() else "cpu"
+    _device = torch.device(base_config.get("device", default_device))
+    if _device.type == "cuda":
+        assert torch.cuda.is_available(), "base.device is cuda but CUDA is unavailable."
+
+    if _device.type == "cpu":
+        # intra-op threads drive every matmul/elementwise kernel on cpu hosts.
+        if base_config.get("num_threads", None):
+            torch.set_num_threads(base_config["num_threads"])
+        if base_config.get("num_interop_threads", None):
+            torch.set_num_interop_threads(base_config["num_interop_threads"])
+
+    autocast_dtype = base_config.get("autocast_dtype", "auto")
+    if autocast_dtype == "auto":
+        if _device.type == "cuda":
+            _autocast_dtype = torch.float16
+        elif cpu_bf16_supported():
+            _autocast_dtype = torch.bfloat16
+        else:
+            _autocast_dtype = None
+    elif autocast_dtype in (None, "none"):
+        _autocast_dtype = None
+    else:
+        _autocast_dtype = eval(autocast_dtype)
+
+    logger.info(
+        f"device : {_device}, num_threads : {torch.get_num_threads()}, "
+        f"autocast_dtype : {_autocast_dtype}"
+    )
+
+
+def get_device():
+    return _device
+
+
+def get_autocast_dtype():
+    return _autocast_dtype
+
+
+def autocast():
+    if _autocast_dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=_device.type, dtype=_autocast_dtype)
+
+
+def empty_cache():
+    if _device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def synchronize():
+    if _device.type == "cuda":
+        torch.cuda.synchronize()
@@ -0,0 +1,168 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import torch
+from collections import defaultdict
+from contextlib import contextmanager
+from .device import get_device
+
+
+def module_bytes(module):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def current_rss():
+    # Resident set size now, unlike ru_maxrss which only ever grows.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class Tracer:
+    """
+    Records spans with their wall time, the bytes moved between host and
+    device and their memory: the cuda allocator peak, or on cpu the resident
+    set size at the end of the span and its change over the span. Moves are
+    counted where blocks and layers are moved, not per op. Disabled spans
+    cost nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.bytes_moved = 0
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_bytes(self, nbytes):
+        if self.enabled:
+            self.bytes_moved += nbytes
+
+    def add_module_bytes(self, module):
+        # A module moved between host and device, only counted on cuda.
+        if self.enabled and get_device().type == "cuda":
+            self.add_bytes(module_bytes(module))
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def memory(self):
+        if get_device().type == "cuda":
+            return torch.cuda.max_memory_allocated()
+        return current_rss()
+
+    @contextmanager
+    def span(self, name, /, **args):
+        if not self.enabled:
+            yield
+            return
+        cuda = get_device().type == "cuda"
+        stack = self.stack()
+        if cuda:
+            # The allocator has one peak counter, hand it over to the parent.
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], self.memory())
+            torch.cuda.reset_peak_memory_stats()
+        start_memory = torch.cuda.memory_allocated() if cuda else current_rss()
+        record = {"name": name, "peak": 0, "bytes": self.bytes_moved}
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            stack.pop()
+            if cuda:
+                memory = max(record["peak"], self.memory())
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], memory)
+                torch.cuda.reset_peak_memory_stats()
+            else:
+                memory = self.memory()
+            args["bytes_moved"] = self.bytes_moved - record["bytes"]
+            args["memory"] = memory
+            args["memory_delta"] = memory - start_memory
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def export(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        stats = defaultdict(lambda: [0, 0.0, 0.0, 0, 0, 0])
+        for event in self.events:
+            stat = stats[event["name"]]
+            stat[0] += 1
+            stat[1] += event["dur"] / 1e6
+            stat[2] = max(stat[2], event["dur"] / 1e6)
+            stat[3] += event["args"]["bytes_moved"]
+            stat[4] = max(stat[4], event["args"]["memory"])
+            stat[5] = max(stat[5], event["args"]["memory_delta"])
+        lines = [
+            f"{'span':<20}{'count':>8}{'total(s)':>12}{'mean(s)':>12}"
+            f"{'max(s)':>12}{'moved(MB)':>12}{'mem(MB)':>12}{'delta(MB)':>12}"
+        ]
+        for name, (count, total, longest, moved, memory, delta) in sorted(
+            stats.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                f"{name:<20}{count:>8}{total:>12.3f}{total / count:>12.3f}"
+                f"{longest:>12.3f}{moved / 1024**2:>12.1f}{memory / 1024**2:>12.1f}"
+                f"{delta / 1024**2:>12.1f}"
+            )
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    # Int, float and str arguments of the call (e.g. the block idx) are kept
+    # on the span. A span calling super() into the same name is not repeated.
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = tracer.stack() if tracer.enabled else None
+            if not tracer.enabled or (stack and stack[-1]["name"] == name):
+                return func(*args, **kwargs)
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            span_args = {
+                k: v for k, v in bound.items() if isinstance(v, (int, float, str))
+            }
+            with tracer.span(name, **span_args):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
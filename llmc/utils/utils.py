@@ -1,6 +1,7 @@
 import torch
 import os
 import random
+import hashlib
 import numpy as np
 
 
@@ -40,10 +41,27 @@ def check_config(config):
                 config.save.get("save_fake", False)
                 and config.save.get("save_quant", False)
             ), "Saving fake quant and saving real quant conflict now."
+    if config.quant.method == "HQQ" and config.quant.get("special", {}).get("axis") == 0:
+        # RealQuantLinear packs groups along the input channels only.
+        real_quant = ("eval" in config and "real_quant" in config.eval.eval_pos) or (
+            "save" in config and config.save.get("save_quant", False)
+        )
+        assert not real_quant, "HQQ with axis 0 can not real_quant, set axis to 1."
 
 
-def mkdirs(path):
+def mkdirs(path, exist_ok=False):
     if not os.path.exists(path):
         os.makedirs(path)
-    else:
+    elif not exist_ok:
         raise Exception(f"{path} existed before. Need check.")
+
+
+def cache_key(tokenizer, *args):
+    # Identifies data tokenized by ``tokenizer`` from the sources in ``args``.
+    key = [
+        type(tokenizer).__name__,
+        tokenizer.name_or_path,
+        sorted(tokenizer.get_vocab().items()),
+        *args,
+    ]
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
@@ -0,0 +1,296 @@
+import os
+import sys
+import glob
+import shutil
+import json
+import hashlib
+import time
+import yaml
+import torch
+import resource
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append("..")
+from loguru import logger
+from easydict import EasyDict
+from datasets import Dataset
+from tokenizers import Tokenizer, pre_tokenizers
+from tokenizers.models import WordLevel
+from transformers import AutoModelForCausalLM, PreTrainedTokenizerFast
+from transformers import (
+    LlamaConfig,
+    MistralConfig,
+    OPTConfig,
+    BloomConfig,
+    FalconConfig,
+    GPTBigCodeConfig,
+)
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs")
+
+
+def model_config(model_type, hidden, layers, vocab):
+    # Layers of the real model family at a smaller hidden size, with 128-dim heads.
+    heads = hidden // 128
+    # Llama sizes its MLP as 8/3 of hidden rounded up to a multiple of 256.
+    llama_intermediate = (hidden * 8 // 3 + 255) // 256 * 256
+    if model_type == "Llama":
+        return LlamaConfig(
+            hidden_size=hidden,
+            intermediate_size=llama_intermediate,
+            num_attention_heads=heads,
+            num_hidden_layers=layers,
+            vocab_size=vocab,
+        )
+    if model_type == "Mistral":
+        return MistralConfig(
+            hidden_size=hidden,
+            intermediate_size=hidden * 7 // 2,
+            num_attention_heads=heads,
+            num_key_value_heads=max(heads // 4, 1),
+            num_hidden_layers=layers,
+            vocab_size=vocab,
+        )
+    if model_type == "Opt":
+        return OPTConfig(
+            hidden_size=hidden,
+            ffn_dim=hidden * 4,
+            num_attention_heads=heads,
+            num_hidden_layers=layers,
+            word_embed_proj_dim=hidden,
+            vocab_size=vocab,
+        )
+    if model_type == "Bloom":
+        return BloomConfig(
+            hidden_size=hidden, n_head=heads, n_layer=layers, vocab_size=vocab
+        )
+    if model_type == "Falcon":
+        # Falcon adapts FalconForCausalLM checkpoints as the new decoder architecture.
+        return FalconConfig(
+            hidden_size=hidden,
+            num_attention_heads=heads,
+            num_kv_heads=max(heads // 4, 1),
+            num_hidden_layers=layers,
+            new_decoder_architecture=True,
+            vocab_size=vocab,
+        )
+    if model_type == "Starcoder":
+        return GPTBigCodeConfig(
+            n_embd=hidden,
+            n_inner=hidden * 4,
+            n_head=heads,
+            n_layer=layers,
+            multi_query=True,
+            vocab_size=vocab,
+        )
+    # InternLM2 only ships as remote code, which can not be built offline.
+    return None
+
+
+def build_tokenizer(vocab):
+    # One word per token, the words being w1 ... w{vocab - 1} after <unk>.
+    words = {f"w{i}": i for i in range(1, vocab)}
+    tokenizer = Tokenizer(WordLevel({"<unk>": 0, **words}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>")
+
+
+def build_checkpoint(model_type, args):
+    # Checkpoints are cached in work_dir, keyed by their config.
+    config = model_config(model_type, args.hidden, args.layers, args.vocab)
+    key = hashlib.md5(config.to_json_string().encode()).hexdigest()[:8]
+    path = os.path.join(args.work_dir, f"{model_type}_{key}")
+    if not os.path.exists(os.path.join(path, "tokenizer.json")):
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(config)
+        model.save_pretrained(path)
+        build_tokenizer(args.vocab).save_pretrained(path)
+    return path
+
+
+def build_corpus(name, n_rows, lengths, args):
+    # Random words, in both the text and sentence columns the preprocs read.
+    path = os.path.join(
+        args.work_dir, f"{name}_{args.vocab}_{n_rows}_{'_'.join(map(str, lengths))}"
+    )
+    if not os.path.exists(path):
+        generator = torch.Generator().manual_seed(0)
+        rows = []
+        for i in range(n_rows):
+            ids = torch.randint(
+                1, args.vocab, (lengths[i % len(lengths)],), generator=generator
+            )
+            rows.append(" ".join(f"w{j}" for j in ids.tolist()))
+        Dataset.from_dict({"text": rows, "sentence": rows}).save_to_disk(path)
+    return path
+
+
+def algo_config(method, model_type):
+    # A config of the method shipped in configs/, the one for the model if any.
+    files = sorted(glob.glob(os.path.join(CONFIG_DIR, "quantization", method, "*.yml")))
+    for key in (model_type.lower(), "fakequant_eval"):
+        matched = [f for f in files if key in os.path.basename(f)]
+        if matched:
+            return matched[0]
+    return files[0]
+
+
+def run(model_type, method, path, config_file, calib_path, eval_path, args):
+    # Runs in a fresh process, so peak RSS belongs to this model and method.
+    from llmc.__main__ import main
+    from llmc.utils import check_config, init_device, seed_all, tracer
+
+    logger.remove()
+    with open(config_file) as f:
+        config = EasyDict(yaml.safe_load(f))
+    config.base.device = "cpu"
+    config.model.type = model_type
+    config.model.path = path
+    config.model.torch_dtype = args.dtype
+    config.model.tokenizer_mode = "fast"
+    if "calib" in config:
+        config.calib.update(
+            download=False,
+            load_from_txt=False,
+            path=calib_path,
+            n_samples=args.n_samples,
+            seq_len=args.seq_len,
+        )
+    if "eval" in config:
+        config.eval.update(
+            name="wikitext2", download=False, path=eval_path, seq_len=args.seq_len, bs=1
+        )
+    # Save the fake quant model at least, along with what the config saves.
+    config.save = EasyDict(config.get("save", {}), save_fake=True)
+    config.save.save_path = os.path.join(args.work_dir, "save", f"{model_type}_{method}")
+    shutil.rmtree(config.save.save_path, ignore_errors=True)
+    if "special" in config.quant and "epochs" in config.quant.special:
+        config.quant.special.epochs = args.epochs
+    if args.trace:
+        config.base.trace_path = os.path.join(
+            args.work_dir, "trace", f"{model_type}_{method}.json"
+        )
+
+    check_config(config)
+    seed_all(config.base.seed)
+    init_device(config.base)
+    if args.trace:
+        tracer.enable()
+    tick = time.perf_counter()
+    main(config)
+    total = time.perf_counter() - tick
+
+    spans = {}
+    for event in tracer.events:
+        spans[event["name"]] = spans.get(event["name"], 0) + event["dur"] / 1e6
+    n_tokens = args.n_samples * args.seq_len if "calib" in config else 0
+    return {
+        "config": os.path.relpath(config_file, CONFIG_DIR),
+        "eval_pos": list(config.eval.eval_pos) if "eval" in config else [],
+        "total_s": total,
+        "spans_s": spans if args.trace else None,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "calib_tokens_per_s": (
+            n_tokens / spans["block_opt"] if n_tokens and "block_opt" in spans else None
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="*", default=None)
+    parser.add_argument("--algos", type=str, nargs="*", default=None)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--dtype", type=str, default="torch.float32")
+    parser.add_argument("--n_samples", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=256)
+    # Windows of seq_len tokens in the perplexity eval data.
+    parser.add_argument("--eval_samples", type=int, default=4)
+    # Epochs of the learnable methods (OmniQuant, NormTweaking).
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--work_dir", type=str, default="./benchmark_e2e")
+    parser.add_argument("--output", type=str, default=None)
+    # Trace each run into work_dir/trace, adds the spans and calib tokens/s.
+    parser.add_argument("--trace", action="store_true")
+    args = parser.parse_args()
+
+    import llmc.models  # noqa: F401
+    import llmc.compression.quantization  # noqa: F401
+    from llmc.utils.registry_factory import ALGO_REGISTRY, MODEL_REGISTRY
+
+    models = args.models or list(MODEL_REGISTRY.keys())
+    algos = args.algos or list(ALGO_REGISTRY.keys())
+    os.makedirs(args.work_dir, exist_ok=True)
+    # Rows shorter than seq_len for the preprocs concatenating short lines
+    # (pileval_awq yields one window less), longer for those cropping a window.
+    calib_path = build_corpus(
+        "calib", 2 * args.n_samples, [args.seq_len - 1, 2 * args.seq_len], args
+    )
+    eval_path = build_corpus("eval", args.eval_samples, [args.seq_len], args)
+
+    results = {}
+    for model_type in models:
+        results[model_type] = {}
+        if model_config(model_type, args.hidden, args.layers, args.vocab) is None:
+            logger.info(f"{model_type} : skipped, needs remote code to build offline")
+            results[model_type] = {"skipped": "needs remote code to build offline"}
+            continue
+        path = build_checkpoint(model_type, args)
+        for method in algos:
+            config_file = algo_config(method, model_type)
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                future = executor.submit(
+                    run,
+                    model_type,
+                    method,
+                    path,
+                    config_file,
+                    calib_path,
+                    eval_path,
+                    args,
+                )
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": f"{type(e).__name__}: {e}"}
+            results[model_type][method] = result
+            if "error" in result:
+                logger.info(f"{model_type:<10} {method:<13} failed : {result['error']}")
+                continue
+            tokens_per_s = result["calib_tokens_per_s"]
+            tokens_per_s = "-" if tokens_per_s is None else f"{tokens_per_s:.1f}"
+            spans = result["spans_s"] or {}
+            spans = ", ".join(f"{k} {v:.2f}s" for k, v in spans.items())
+            logger.info(
+                f"{model_type:<10} {method:<13} total {result['total_s']:8.2f}s  "
+                f"peak {result['peak_rss_mb']:8.0f}MB  "
+                f"calib {tokens_per_s:>8} tok/s  {spans}"
+            )
+
+    report = {
+        "meta": {
+            "hidden": args.hidden,
+            "layers": args.layers,
+            "vocab": args.vocab,
+            "dtype": args.dtype,
+            "n_samples": args.n_samples,
+            "seq_len": args.seq_len,
+            "eval_samples": args.eval_samples,
+            "epochs": args.epochs,
+            "threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"results saved to {args.output}")
@@ -0,0 +1,232 @@
+import copy
+import time
+import torch
+import argparse
+import sys
+
+sys.path.append("..")
+from loguru import logger
+from easydict import EasyDict
+from llmc.compression.quantization import GPTQ, Quantizer
+
+
+class BaselineGPTQ:
+    # GPTQ's column sweep and list-of-dicts group qparams as they were before
+    # they got vectorized, copied verbatim as the reference.
+    @torch.no_grad()
+    def weight_transform(self, W, Hinv, Losses, tmp):
+        for i1 in range(0, self.n_nonout, self.blocksize):
+            i2 = min(i1 + self.blocksize, self.n_nonout)
+            count = i2 - i1
+            W1 = W[:, i1:i2].clone()
+            tmp1 = torch.zeros_like(W1)
+            Err1 = torch.zeros_like(W1)
+            Losses1 = torch.zeros_like(W1)
+            Hinv1 = Hinv[i1:i2, i1:i2]
+            for i in range(count):
+                w = W1[:, i]
+                d = Hinv1[i, i]
+
+                if self.wquantizer.granularity == "per_group":
+                    idx = i1 + i
+                    if not self.static_groups:
+                        if (i1 + i) % self.wquantizer.group_size == 0:
+                            column_tensors = W[
+                                :,
+                                (i1 + i) : min(
+                                    (i1 + i + self.wquantizer.group_size),
+                                    (self.columns - self.n_out),
+                                ),
+                            ]
+                            self.search_column_qparams(column_tensors, idx)
+
+                    else:
+                        if self.actorder:
+                            idx = self.perm[idx]
+                        self.qparams = self.groups[idx // self.wquantizer.group_size]
+
+                q = self.wquantizer.quant_dequant(
+                    w.unsqueeze(1),
+                    self.qparams["scale"],
+                    self.qparams["zero"],
+                    self.qparams["max_int"],
+                    self.qparams["min_int"],
+                ).squeeze(1)
+
+                tmp1[:, i] = w
+
+                Losses1[:, i] = (w - q) ** 2 / d**2
+                err1 = (w - q) / d
+                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
+                Err1[:, i] = err1
+
+            tmp[:, i1:i2] = tmp1
+            Losses[:, i1:i2] = Losses1 / 2
+            W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
+
+    @torch.no_grad()
+    def split_qparams(self, qparams):
+        group_qparams = []
+        group_num = self.columns // self.wquantizer.group_size
+        qparams = qparams.reshape(qparams.shape[0] // group_num, -1)
+        qparams = qparams.t()
+        group_qparams = list(torch.split(qparams, 1, dim=0))
+        for i in range(len(group_qparams)):
+            group_qparams[i] = group_qparams[i].reshape(-1, 1)
+        return group_qparams
+
+    @torch.no_grad()
+    def merge_qparams(self, qparams):
+        if isinstance(qparams, int):
+            return qparams
+        if self.wquantizer.granularity == "per_head":
+            head_size = self.rows // self.head_num
+            qparams = qparams.t()
+            qparams = qparams.repeat(head_size, 1)
+            qparams = qparams.t()
+            qparams = qparams.reshape(-1, 1)
+        elif self.wquantizer.granularity == "per_group":
+            qparams = torch.stack(qparams, dim=1)
+            qparams = qparams.reshape(-1, 1)
+        return qparams
+
+    @torch.no_grad()
+    def search_column_qparams(self, c_tensor, idx):
+        _, scale, zero, max_int, min_int = self.wquantizer.get_tensor_qparams(c_tensor)
+        self.qparams["scale"] = scale
+        self.qparams["zero"] = zero
+        self.qparams["max_int"] = max_int
+        self.qparams["min_int"] = min_int
+        qparams = copy.deepcopy(self.qparams)
+        self.groups[idx // self.wquantizer.group_size] = qparams
+
+    @torch.no_grad()
+    def search_group_qparams(self, layer):
+        scales = layer.buf_scales
+        zeros = layer.buf_zeros
+        self.group_scales = self.split_qparams(scales)
+        if zeros is not None:
+            self.group_zeros = self.split_qparams(zeros)
+        for i in range(len(self.group_scales)):
+            qparams = {}
+            qparams["scale"] = self.group_scales[i]
+            if zeros is not None:
+                qparams["zero"] = self.group_zeros[i]
+            else:
+                qparams["zero"] = None
+            qparams["max_int"] = layer.buf_max_int
+            qparams["min_int"] = layer.buf_min_int
+            self.groups.append(qparams)
+
+    @torch.no_grad()
+    def update_model_qparams(self, layer):
+        _scales = []
+        _zeros = []
+        for g in self.groups:
+            _scales.append(g["scale"])
+            _zeros.append(g["zero"])
+        scales = self.merge_qparams(_scales)
+        zeros = self.merge_qparams(_zeros)
+        layer.buf_scales = copy.deepcopy(scales)
+        layer.buf_zeros = copy.deepcopy(zeros)
+
+
+def build(cls, W, H, args):
+    gptq = cls.__new__(cls)
+    granularity = "per_group" if args.group_size > 0 else "per_channel"
+    gptq.wquantizer = Quantizer(
+        args.bit, args.symmetric, granularity, group_size=args.group_size
+    )
+    gptq.static_groups = args.static_groups
+    gptq.actorder = args.actorder
+    gptq.blocksize = args.blocksize
+    gptq.columns = gptq.n_nonout = W.shape[1]
+    gptq.n_out = 0
+    gptq.perm = torch.argsort(torch.diag(H), descending=True)
+    gptq.qparams = {}
+    gptq.groups = []
+    if granularity == "per_group":
+        layer = EasyDict()
+        (
+            _,
+            layer.buf_scales,
+            layer.buf_zeros,
+            layer.buf_max_int,
+            layer.buf_min_int,
+        ) = gptq.wquantizer.get_tensor_qparams(W)
+        gptq.search_group_qparams(layer)
+    else:
+        _, s, z, max_int, min_int = gptq.wquantizer.get_tensor_qparams(W)
+        gptq.qparams = {"scale": s, "zero": z, "max_int": max_int, "min_int": min_int}
+    return gptq
+
+
+def run(gptq, W, Hinv):
+    W = W.clone()
+    Losses, tmp = torch.zeros_like(W), torch.zeros_like(W)
+    tick = time.perf_counter()
+    gptq.weight_transform(W, Hinv, Losses, tmp)
+    return time.perf_counter() - tick, tmp, Losses
+
+
+def model_qparams(gptq, args):
+    # The dynamic group qparams GPTQ writes back to the layer, the baseline
+    # can not merge the zeros of symmetric groups, so only compare the scales.
+    if args.group_size <= 0 or args.static_groups:
+        return []
+    if args.symmetric:
+        if isinstance(gptq, BaselineGPTQ):
+            return [gptq.merge_qparams([g["scale"] for g in gptq.groups])]
+        return [gptq.group_scales.reshape(-1, 1)]
+    layer = EasyDict()
+    gptq.update_model_qparams(layer)
+    return [layer.buf_scales, layer.buf_zeros]
+
+
+def benchmark(shape, args):
+    rows, cols = shape
+    torch.manual_seed(0)
+    X = torch.randn(2 * cols, cols) * torch.rand(cols)
+    H = X.t() @ X / X.shape[0]
+    H += 0.01 * torch.diag(H).mean() * torch.eye(cols)
+    W = torch.randn(rows, cols) * 0.02
+
+    perm = torch.argsort(torch.diag(H), descending=True)
+    if args.actorder:
+        H = H[perm][:, perm]
+    Hinv = torch.linalg.cholesky(
+        torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True
+    )
+    Wp = W[:, perm] if args.actorder else W
+
+    baseline, gptq = build(BaselineGPTQ, W, H, args), build(GPTQ, W, H, args)
+    loop_time, ref, ref_losses = run(baseline, Wp, Hinv)
+    new_time, out, losses = run(gptq, Wp, Hinv)
+    assert torch.equal(ref, out) and torch.equal(ref_losses, losses)
+    for ref_qparams, qparams in zip(model_qparams(baseline, args), model_qparams(gptq, args)):
+        assert torch.equal(ref_qparams, qparams)
+
+    logger.info(
+        f"shape {rows}x{cols} : baseline {loop_time:.2f} s, "
+        f"vectorized {new_time:.2f} s ({loop_time / new_time:.2f}x), identical"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shapes",
+        type=str,
+        nargs="*",
+        default=["4096x4096", "11008x4096", "4096x11008", "14336x4096"],
+    )
+    parser.add_argument("--bit", type=int, default=4)
+    parser.add_argument("--symmetric", action="store_true")
+    parser.add_argument("--group_size", type=int, default=128)
+    parser.add_argument("--static_groups", action="store_true")
+    parser.add_argument("--actorder", action="store_true")
+    parser.add_argument("--blocksize", type=int, default=128)
+    args = parser.parse_args()
+
+    for shape in args.shapes:
+        benchmark(tuple(int(s) for s in shape.split("x")), args)
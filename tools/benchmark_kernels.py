@@ -0,0 +1,299 @@
+import time
+import json
+import torch
+import platform
+import argparse
+import subprocess
+import statistics
+import sys
+
+sys.path.append("..")
+from loguru import logger
+from easydict import EasyDict
+from llmc.utils import init_device
+from llmc.compression.quantization import Quantizer, Awq, GPTQ, HQQ, DGQ, SpQR
+from llmc.compression.quantization.module_utils import RealQuantLinear
+from benchmark_gptq import build as build_gptq
+
+# Layer sizes of the models we quantize most.
+PRESETS = {
+    "llama-7b": {"hidden": 4096, "intermediate": 11008},
+    "mistral-7b": {"hidden": 4096, "intermediate": 14336},
+    "llama-70b": {"hidden": 8192, "intermediate": 28672},
+    "tiny": {"hidden": 512, "intermediate": 1376},
+}
+
+CASES = {}
+
+
+def case(name):
+    def register(func):
+        CASES[name] = func
+        return func
+
+    return register
+
+
+def weight(rows, cols):
+    # Heavy-tailed like trained weights, with a few hot input channels.
+    w = torch.distributions.StudentT(4).sample((rows, cols)) * 0.02
+    return w * (1 + 4 * (torch.rand(cols) > 0.99))
+
+
+def activation(tokens, channels):
+    return torch.randn(tokens, channels) * (1 + 9 * (torch.rand(channels) > 0.99))
+
+
+def hessian_inverse(cols, tokens):
+    X = activation(max(tokens, 2 * cols), cols)
+    H = X.t() @ X / X.shape[0]
+    H += 0.01 * torch.diag(H).mean() * torch.eye(cols)
+    return torch.linalg.cholesky(
+        torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True
+    ), H
+
+
+def quant_dequant_case(granularity, act=False):
+    def setup(p, args):
+        if act:
+            q = Quantizer(8, True, granularity)
+            t = q.reshape_tensor(activation(args.tokens, p["hidden"]))
+        else:
+            q = Quantizer(4, False, granularity, group_size=128)
+            t = q.reshape_tensor(weight(p["intermediate"], p["hidden"]))
+        _, s, z, max_int, min_int = q.get_tensor_qparams(t)
+        return lambda: q.quant_dequant(t, s, z, max_int, min_int)
+
+    return setup
+
+
+for granularity in ("per_channel", "per_group", "per_tensor"):
+    case(f"quant_dequant/{granularity}")(quant_dequant_case(granularity))
+case("quant_dequant/per_token")(quant_dequant_case("per_token", act=True))
+
+
+@case("get_mse_range/per_group")
+def mse_range(p, args):
+    q = Quantizer(4, False, "per_group", group_size=128, calib_algo="mse")
+    t = q.reshape_tensor(weight(p["hidden"], p["hidden"]))
+    return lambda: q.get_mse_range(t)
+
+
+@case("real_quant/pack")
+def pack(p, args):
+    config = {"weight": {"bit": 4, "granularity": "per_group", "group_size": 128}}
+    rows, cols = p["intermediate"], p["hidden"]
+    w = torch.randint(0, 16, (rows, cols), dtype=torch.int32)
+    s = torch.rand(rows * cols // 128, 1)
+    z = torch.randint(0, 16, (rows * cols // 128, 1), dtype=torch.int32)
+    return lambda: RealQuantLinear.pack(w, s, z, config)
+
+
+@case("gptq/weight_transform")
+def gptq_weight_transform(p, args):
+    cols = p["hidden"]
+    W = weight(p["hidden"], cols)
+    Hinv, H = hessian_inverse(cols, args.tokens)
+    gptq_args = EasyDict(
+        bit=4,
+        symmetric=False,
+        group_size=128,
+        static_groups=False,
+        actorder=False,
+        blocksize=128,
+    )
+    gptq = build_gptq(GPTQ, W, H, gptq_args)
+
+    def run():
+        W1 = W.clone()
+        gptq.weight_transform(W1, Hinv, torch.zeros_like(W), torch.zeros_like(W))
+
+    return run
+
+
+def awq(p):
+    a = Awq.__new__(Awq)
+    a.wquantizer = Quantizer(4, False, "per_group", group_size=128)
+    a.version, a.w_only, a.grid_batch, a.clip_mem_gb = "v2", True, 1, 2
+    return a
+
+
+@case("awq/search_scale_subset")
+def awq_search_scale(p, args):
+    a = awq(p)
+    fc = torch.nn.Linear(p["intermediate"], p["hidden"], bias=False)
+    fc.weight.data = weight(p["hidden"], p["intermediate"])
+    fc.requires_grad_(False)
+    x = [activation(args.tokens, p["intermediate"]).unsqueeze(0)]
+    a.n_samples = 1
+    return lambda: a.search_scale_subset([fc], x, fc, {})
+
+
+@case("awq/auto_clip_layer")
+def awq_auto_clip(p, args):
+    a = awq(p)
+    w = weight(p["hidden"], p["hidden"])
+    x = [activation(args.tokens, p["hidden"]).unsqueeze(0)]
+    return lambda: a.auto_clip_layer(w, x)
+
+
+@case("hqq/optimize_weights_proximal")
+def hqq_proximal(p, args):
+    h = HQQ.__new__(HQQ)
+    h.quant_config = {
+        "special": {"axis": 1, "lp_norm": 0.7, "beta": 10, "kappa": 1.01, "iters": 20}
+    }
+    h.wquantizer = Quantizer(4, False, "per_group", group_size=64, round_zp=False)
+    h.add_quant_config()
+    t, s, z, max_int, min_int = h.wquantizer.get_tensor_qparams(
+        weight(p["intermediate"], p["hidden"])
+    )
+    return lambda: h.optimize_weights_proximal(t, s, z, max_int, min_int)
+
+
+@case("dgq/search_scale_zero_layer")
+def dgq_search(p, args):
+    d = DGQ.__new__(DGQ)
+    d.quant_config = {
+        "weight": {
+            "w_1": {
+                "bit": 4,
+                "symmetric": False,
+                "granularity": "per_group",
+                "group_size": 128,
+            },
+            "w_2": {"bit": 8, "symmetric": True, "granularity": "per_channel"},
+        },
+        "act": {"bit": 8, "symmetric": True, "granularity": "per_token"},
+    }
+    d.set_quant_config()
+    d.model_dtype = torch.float32
+    fc = torch.nn.Linear(p["hidden"], p["hidden"], bias=False)
+    fc.weight.data = weight(p["hidden"], p["hidden"])
+    x = activation(args.tokens, p["hidden"])
+    return lambda: d.search_scale_zero_layer(fc, x)
+
+
+@case("spqr/outlier_weight_transform")
+def spqr_outliers(p, args):
+    q3 = {"bit": 3, "symmetric": False, "granularity": "per_group", "group_size": 16}
+    sp = SpQR.__new__(SpQR)
+    sp.wquantizer = Quantizer(4, False, "per_group", group_size=16, round_zp=False)
+    sp.scale_quantizer = Quantizer(**q3, round_zp=False)
+    sp.zero_quantizer = Quantizer(**q3, round_zp=False)
+    sp.Q = Quantizer(4, False, "per_channel", round_zp=False)
+    sp.relative_threshold, sp.simplified_outliers = 0.2, False
+    sp.columns, sp.blocksize = p["hidden"], 128
+    W = weight(p["hidden"], p["hidden"])
+    Hinv, _ = hessian_inverse(p["hidden"], args.tokens)
+
+    def run():
+        sp.qparams, sp.groups = {}, [None] * (sp.columns // 16)
+        W1 = W.clone()
+        mask = torch.zeros_like(W, dtype=torch.bool)
+        sp.weight_transform(W1, Hinv, torch.zeros_like(W), torch.zeros_like(W), mask)
+
+    return run
+
+
+def timeit(func, warmup, repeat, min_time):
+    # Fast kernels are repeated until they ran for min_time, to steady the median.
+    for _ in range(warmup):
+        func()
+    times = []
+    while len(times) < repeat or sum(times) < min_time:
+        tick = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - tick)
+    return times
+
+
+def git_rev():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median_s"] / baseline[name]["median_s"]
+        status = "REGRESSION" if ratio > 1 + threshold else "ok"
+        if status != "ok":
+            regressions.append(name)
+        logger.info(
+            f"{name:<36} baseline {baseline[name]['median_s'] * 1000:10.2f} ms  "
+            f"now {result['median_s'] * 1000:10.2f} ms  {ratio:6.2f}x  {status}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", type=str, default="llama-7b", choices=list(PRESETS))
+    parser.add_argument("--cases", type=str, nargs="*", default=list(CASES))
+    parser.add_argument("--tokens", type=int, default=512)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min_time", type=float, default=1.0)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    # Relative slowdown of the median over the baseline counted as a regression.
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    # Keep the logs of the algorithms out of the results.
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", filter=lambda r: r["name"] == "__main__")
+    init_device(EasyDict({"device": "cpu", "num_threads": args.threads}))
+
+    results = {}
+    for name in args.cases:
+        torch.manual_seed(0)
+        func = CASES[name](PRESETS[args.preset], args)
+        times = timeit(func, args.warmup, args.repeat, args.min_time)
+        results[name] = {
+            "median_s": statistics.median(times),
+            "best_s": min(times),
+            "times_s": times,
+        }
+        logger.info(
+            f"{name:<36} median {results[name]['median_s'] * 1000:10.2f} ms  "
+            f"best {results[name]['best_s'] * 1000:10.2f} ms"
+        )
+
+    report = {
+        "meta": {
+            "preset": args.preset,
+            "shapes": PRESETS[args.preset],
+            "tokens": args.tokens,
+            "repeat": args.repeat,
+            "min_time": args.min_time,
+            "threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "git": git_rev(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["preset"] != args.preset:
+            logger.info(f"baseline preset is {baseline['meta']['preset']}")
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            logger.info(f"regressions : {regressions}")
+            sys.exit(1)
@@ -0,0 +1,76 @@
+import time
+import torch
+import argparse
+import sys
+
+sys.path.append("..")
+from loguru import logger
+from llmc.compression.quantization import pack_tensor, unpack_tensor
+
+
+def loop_pack(weight, zeros, bit):
+    # The packing RealQuantLinear.pack used to do, one column at a time.
+    h1, h2 = weight.shape
+    tmp = 32 // bit
+    int_weight = torch.zeros(h1, h2 // tmp, dtype=torch.int32)
+    for pack in range(0, h2, tmp):
+        for i in range(tmp):
+            int_weight[:, pack // tmp] += weight[:, pack + i] << (i * bit)
+    int_zeros = torch.zeros(h1 // tmp, zeros.shape[1], dtype=torch.int32)
+    for pack in range(0, h1, tmp):
+        for i in range(tmp):
+            int_zeros[pack // tmp, :] += zeros[pack + i, :] << (i * bit)
+    return int_weight, int_zeros
+
+
+def vec_pack(weight, zeros, bit):
+    return pack_tensor(weight, bit, dim=1), pack_tensor(zeros, bit, dim=0)
+
+
+def timeit(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        tick = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - tick)
+    return best, out
+
+
+def benchmark(shape, bit, group_size, repeat):
+    h1, h2 = shape
+    group_size = h2 if group_size == -1 else group_size
+    weight = torch.randint(0, 2**bit, (h1, h2), dtype=torch.int32)
+    zeros = torch.randint(0, 2**bit, (h1, h2 // group_size), dtype=torch.int32)
+
+    loop_time, (ref_weight, ref_zeros) = timeit(loop_pack, weight, zeros, bit, repeat=1)
+    vec_time, (int_weight, int_zeros) = timeit(vec_pack, weight, zeros, bit, repeat=repeat)
+    unpack_time, unpacked = timeit(unpack_tensor, int_weight, bit, 1, repeat=repeat)
+
+    assert torch.equal(ref_weight, int_weight) and torch.equal(ref_zeros, int_zeros)
+    assert torch.equal(unpacked, weight)
+    assert torch.equal(unpack_tensor(int_zeros, bit, 0), zeros)
+    signed = weight - 2 ** (bit - 1)
+    assert torch.equal(unpack_tensor(pack_tensor(signed, bit, 1), bit, 1, True), signed)
+
+    logger.info(
+        f"shape {h1}x{h2} bit {bit} group {group_size} : "
+        f"loop pack {loop_time * 1000:.1f} ms, vectorized pack {vec_time * 1000:.1f} ms "
+        f"({loop_time / vec_time:.1f}x), unpack {unpack_time * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shapes", type=str, nargs="*", default=["4096x4096", "11008x4096", "4096x11008"]
+    )
+    parser.add_argument("--bits", type=int, nargs="*", default=[2, 4, 8])
+    parser.add_argument("--group_sizes", type=int, nargs="*", default=[-1, 128])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for shape in args.shapes:
+        shape = tuple(int(s) for s in shape.split("x"))
+        for bit in args.bits:
+            for group_size in args.group_sizes:
+                benchmark(shape, bit, group_size, args.repeat)
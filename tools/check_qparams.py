@@ -0,0 +1,89 @@
+import os
+import sys
+import yaml
+import torch
+import argparse
+import tempfile
+
+sys.path.append("..")
+from loguru import logger
+from easydict import EasyDict
+from transformers import AutoModelForCausalLM
+from benchmark_e2e import model_config, algo_config
+
+
+def saved_qparams_match(model, blocks, path):
+    # The model files hold every buf_* (sparse ones densified), qparams.pth
+    # the dense ones of the blocks.
+    saved = torch.load(os.path.join(path, "pytorch_model.bin"))
+    for name, buf in model.named_buffers():
+        if ".buf_" in name:
+            if name not in saved or not torch.equal(saved[name], buf.to_dense()):
+                return False
+    if not os.path.exists(os.path.join(path, "qparams.pth")):
+        return True
+    store = QParamStore.load(os.path.join(path, "qparams.pth"))
+    for idx, name in store.index:
+        module = blocks[idx].get_submodule(name)
+        for buf_name, view in store.get(idx, name).items():
+            if not torch.equal(view, getattr(module, buf_name)):
+                return False
+    return True
+
+
+def check(method, path, args):
+    with open(algo_config(method, "Llama")) as f:
+        config = EasyDict(yaml.safe_load(f))
+    config.model.type = "Llama"
+    config.model.path = path
+    seed_all(config.base.seed)
+    model = MODEL_REGISTRY["Llama"](path, "torch.float32")
+    if "calib" in config:
+        config.calib.seq_len = args.seq_len
+        tokens = torch.randint(0, args.vocab, (args.n_samples, args.seq_len))
+        model.collect_first_block_input(list(tokens.split(1)))
+        blockwise_opt = ALGO_REGISTRY[method](
+            model, config.quant, model.get_first_block_input(), config
+        )
+    else:
+        blockwise_opt = ALGO_REGISTRY[method](model, config.quant, config=config)
+    blockwise_opt.run_block_loop()
+    if "cvt" in config and config.get("cvt", True):
+        blockwise_opt.run_block_cvt()
+    blockwise_opt.deploy("fake_quant")
+    with tempfile.TemporaryDirectory() as save_path:
+        blockwise_opt.save_model(save_path)
+        return saved_qparams_match(model.get_model(), blockwise_opt.blocks, save_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--algos", type=str, nargs="*", default=["RTN", "GPTQ", "SpQR"])
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--vocab", type=int, default=1000)
+    parser.add_argument("--n_samples", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=64)
+    args = parser.parse_args()
+
+    import llmc.models  # noqa: F401
+    import llmc.compression.quantization  # noqa: F401
+    from llmc.compression.quantization import QParamStore
+    from llmc.utils import init_device, seed_all
+    from llmc.utils.registry_factory import ALGO_REGISTRY, MODEL_REGISTRY
+
+    # Keep the logs of the algorithms out of the results.
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", filter=lambda r: r["name"] == "__main__")
+    init_device(EasyDict({"device": "cpu"}))
+    failed = []
+    with tempfile.TemporaryDirectory() as path:
+        torch.manual_seed(0)
+        config = model_config("Llama", args.hidden, args.layers, args.vocab)
+        AutoModelForCausalLM.from_config(config).save_pretrained(path)
+        for method in args.algos:
+            ok = check(method, path, args)
+            logger.info(f"{method:<13} save round trip : {'ok' if ok else 'MISMATCH'}")
+            if not ok:
+                failed.append(method)
+    sys.exit(1 if failed else 0)